@@ -0,0 +1,149 @@
+import os
+from typing import Dict, Iterable, Union
+
+try:
+    import numpy as np
+except ImportError:  # optional, only offline analysis needs it
+    raise ImportError('analytics requires numpy. install it with `pip install numpy`.')
+
+from telemetry import MAGIC
+from utils import State
+
+# matches telemetry.RECORD ('<dffbb'), so history files map directly onto it
+SAMPLE_DTYPE = np.dtype([('timestamp', '<f8'), ('temperature', '<f4'), ('setting_temperature', '<f4'),
+                         ('battery', 'i1'), ('state', 'i1')])
+STATE_COUNT = max(state.value for state in State) + 1
+
+
+def decode_temperatures(buffer) -> 'np.ndarray':
+    # contiguous little endian 2 byte frames, 1/100 °C
+    return np.frombuffer(buffer, dtype='<u2') / 100
+
+
+def decode_batteries(buffer) -> 'np.ndarray':
+    # (n, 2) array of charge % and charging flag
+    return np.frombuffer(buffer, dtype='u1').reshape(-1, 2)
+
+
+def decode_states(buffer) -> 'np.ndarray':
+    return np.frombuffer(buffer, dtype='u1')
+
+
+def load_history(path: str) -> 'np.ndarray':
+    # memory mapped, nothing is read until it is used
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{!r} is not a telemetry history file'.format(path))
+    # a record cut off mid-write at the end is left out, like telemetry.History does
+    count = (os.path.getsize(path) - len(MAGIC)) // SAMPLE_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=SAMPLE_DTYPE)
+    return np.memmap(path, dtype=SAMPLE_DTYPE, mode='r', offset=len(MAGIC), shape=(count,))
+
+
+def from_recorder(recorder: 'TelemetryRecorder') -> 'np.ndarray':
+    samples = np.empty(len(recorder), dtype=SAMPLE_DTYPE)
+    rows = recorder.latest()
+    if rows:
+        samples[:] = rows
+    return samples
+
+
+def time_in_state(samples: 'np.ndarray') -> Dict[str, float]:
+    # each interval is attributed to the state of the sample that starts it
+    if len(samples) < 2:
+        return {}
+    durations = np.diff(samples['timestamp'])
+    states = samples['state'][:-1].astype(np.int64)
+    known = states >= 0
+    totals = np.bincount(states[known], weights=durations[known], minlength=STATE_COUNT)
+    return {State(code).name: float(total) for code, total in enumerate(totals) if total > 0}
+
+
+def time_to_target(samples: 'np.ndarray') -> 'np.ndarray':
+    # seconds from each pour until the mug first reports Keeping, nan when it never got there before the next pour
+    states = samples['state']
+    timestamps = samples['timestamp']
+    previous = np.concatenate(([-1], states[:-1]))
+    pours = np.flatnonzero((states == State.Poured.value) & (previous != State.Poured.value))
+    keeps = np.flatnonzero((states == State.Keeping.value) & (previous != State.Keeping.value))
+    if len(keeps) == 0:
+        return np.full(len(pours), np.nan)
+
+    reached = np.searchsorted(keeps, pours)
+    following = np.append(pours[1:], len(states))
+    keep_at = keeps[np.minimum(reached, len(keeps) - 1)]
+    valid = (reached < len(keeps)) & (keep_at < following)
+    result = np.full(len(pours), np.nan)
+    result[valid] = timestamps[keep_at[valid]] - timestamps[pours[valid]]
+    return result
+
+
+def rollup(samples: 'np.ndarray') -> dict:
+    temperature = samples['temperature'].astype(np.float64)
+    battery = samples['battery']
+    known = battery >= 0
+    pours = time_to_target(samples)
+    reached = pours[~np.isnan(pours)]
+    return {
+        'samples': int(len(samples)),
+        'start': float(samples['timestamp'][0]) if len(samples) else None,
+        'end': float(samples['timestamp'][-1]) if len(samples) else None,
+        'temperature_min': float(np.nanmin(temperature)) if np.isfinite(temperature).any() else None,
+        'temperature_max': float(np.nanmax(temperature)) if np.isfinite(temperature).any() else None,
+        'temperature_mean': float(np.nanmean(temperature)) if np.isfinite(temperature).any() else None,
+        'battery_min': int(battery[known].min()) if known.any() else None,
+        'time_in_state': time_in_state(samples),
+        'pours': int(len(pours)),
+        'time_to_target_mean': float(reached.mean()) if len(reached) else None,
+        'time_to_target': pours.tolist(),
+    }
+
+
+def fleet_rollup(samples_by_mug: Dict[str, 'np.ndarray']) -> Dict[str, dict]:
+    # all mugs are concatenated once and reduced per group, instead of looping over mugs in python
+    names = [name for name, samples in samples_by_mug.items() if len(samples)]
+    if not names:
+        return {}
+    parts = [samples_by_mug[name] for name in names]
+    sizes = np.array([len(part) for part in parts])
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    samples = np.concatenate(parts)
+    mug = np.repeat(np.arange(len(names)), sizes)
+
+    temperature = samples['temperature'].astype(np.float64)
+    finite = np.isfinite(temperature)
+    counts = np.bincount(mug[finite], minlength=len(names))
+    sums = np.bincount(mug[finite], weights=temperature[finite], minlength=len(names))
+    lowest = np.fmin.reduceat(np.where(finite, temperature, np.inf), starts)
+    highest = np.fmax.reduceat(np.where(finite, temperature, -np.inf), starts)
+
+    # durations never cross from one mug into the next
+    durations = np.diff(samples['timestamp'], append=samples['timestamp'][-1])
+    durations[starts[1:] - 1] = 0
+    durations[-1] = 0
+    states = samples['state'].astype(np.int64)
+    known = states >= 0
+    per_state = np.bincount(mug[known] * STATE_COUNT + states[known], weights=durations[known],
+                            minlength=len(names) * STATE_COUNT).reshape(len(names), STATE_COUNT)
+
+    result = {}
+    for i, name in enumerate(names):
+        targets = time_to_target(parts[i])
+        reached = targets[~np.isnan(targets)]
+        result[name] = {
+            'samples': int(sizes[i]),
+            'temperature_min': float(lowest[i]) if counts[i] else None,
+            'temperature_max': float(highest[i]) if counts[i] else None,
+            'temperature_mean': float(sums[i] / counts[i]) if counts[i] else None,
+            'time_in_state': {State(code).name: float(total) for code, total in enumerate(per_state[i]) if total > 0},
+            'pours': int(len(targets)),
+            'time_to_target_mean': float(reached.mean()) if len(reached) else None,
+        }
+    return result
+
+
+def load_fleet(paths: Union[Dict[str, str], Iterable[str]]) -> Dict[str, 'np.ndarray']:
+    if not isinstance(paths, dict):
+        paths = {path: path for path in paths}
+    return {name: load_history(path) for name, path in paths.items()}
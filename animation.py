@@ -0,0 +1,233 @@
+import asyncio
+import time
+from bisect import bisect_right
+from typing import Dict, Iterable, List, NamedTuple, Tuple, Union
+
+from utils import Color
+
+BLACK = Color(0, 0, 0, 0)
+
+
+class Keyframe(NamedTuple):
+    offset: float  # seconds from the start of one cycle
+    color: Color
+
+
+def blend(start: Color, end: Color, t: float) -> Color:
+    return Color(round(start.r + (end.r - start.r) * t), round(start.g + (end.g - start.g) * t),
+                 round(start.b + (end.b - start.b) * t), round(start.a + (end.a - start.a) * t))
+
+
+class Effect:
+    fps = 4.0  # frames computed per second. the mug takes about as many writes, see WriteQueue.min_interval
+
+    def __init__(self, name: str, keyframes: Iterable[Keyframe], repeat: Union[int, None] = 1,
+                 fps: Union[float, None] = None, restore=False):
+        # repeat=None runs until stopped. with restore, the mug gets its previous color back afterwards
+        keyframes = sorted(keyframes, key=lambda keyframe: keyframe.offset)
+        if not keyframes:
+            raise ValueError('an effect needs at least one keyframe')
+        self.name = name
+        self.repeat = repeat
+        self.fps = fps or self.fps
+        self.restore = restore
+        self.duration = keyframes[-1].offset - keyframes[0].offset
+        self.final = keyframes[-1].color
+
+        # frames of one cycle, computed once and shared by every mug playing the effect: each keyframe offset, then
+        # the fps steps where the color changes. a frame repeating the previous color is left out
+        start = keyframes[0].offset
+        self.frames: List[Tuple[float, Color]] = []
+        for first, second in zip(keyframes, keyframes[1:]):
+            begin, end = first.offset - start, second.offset - start
+            if end > begin:
+                self._sample(first.color, second.color, begin, end)
+        self.offsets = [offset for offset, _ in self.frames]
+
+    def _sample(self, first: Color, second: Color, begin: float, end: float):
+        # every channel moves one way only, so the first step with a new color is found by bisection. that is at
+        # most a few hundred searches per keyframe pair, however long it lasts
+        def color_at(offset: float) -> Color:
+            return blend(first, second, (offset - begin) / (end - begin))
+
+        low = int(begin * self.fps)  # fps steps strictly between begin and end
+        while low / self.fps <= begin:
+            low += 1
+        high = int(end * self.fps) + 1
+        while high / self.fps >= end:
+            high -= 1
+
+        offset, color = begin, first
+        while True:
+            if not self.frames or self.frames[-1][1] != color:
+                self.frames.append((offset, color))
+            lo, hi = low, high + 1
+            while lo < hi:
+                middle = (lo + hi) // 2
+                if color_at(middle / self.fps) == color:
+                    lo = middle + 1
+                else:
+                    hi = middle
+            if lo > high:
+                return
+            offset, color, low = lo / self.fps, color_at(lo / self.fps), lo + 1
+
+    @property
+    def length(self) -> Union[int, None]:
+        # number of the final frame, None when the effect loops forever
+        if self.repeat is None:
+            return None
+        return self.repeat * len(self.frames)
+
+    def frame(self, elapsed: float) -> Tuple[int, Color]:
+        # the frame showing after elapsed seconds as (number counted across repeats, color)
+        if not self.frames:
+            return 0, self.final
+        cycle, offset = divmod(max(0.0, elapsed), self.duration)
+        if self.repeat is not None and cycle >= self.repeat:
+            return self.length, self.final
+        index = bisect_right(self.offsets, offset) - 1
+        return int(cycle) * len(self.frames) + index, self.frames[index][1]
+
+    def next_offset(self, number: int) -> float:
+        # seconds from the start until the frame after number is due
+        cycle, index = divmod(number + 1, len(self.frames) or 1)
+        return cycle * self.duration + (self.offsets[index] if self.frames else 0.0)
+
+
+def fade(end: Color, seconds: float = 2.0, start: Color = BLACK) -> Effect:
+    return Effect('fade', [Keyframe(0.0, start), Keyframe(seconds, end)])
+
+
+def pulse(color: Color, period: float = 2.0, repeat: Union[int, None] = None, low: float = 0.1) -> Effect:
+    dim = blend(BLACK, color, low)
+    return Effect('pulse', [Keyframe(0.0, dim), Keyframe(period / 2, color), Keyframe(period, dim)], repeat,
+                  restore=True)
+
+
+def blink(color: Color, times: int = 3, period: float = 0.5) -> Effect:
+    # e.g. when a drink is ready
+    return Effect('blink', [Keyframe(0.0, color), Keyframe(period / 2, color), Keyframe(period / 2, BLACK),
+                            Keyframe(period, BLACK)], times, restore=True)
+
+
+class Playback:
+    def __init__(self, address: str, effect: Effect, started_at: float, interval: float,
+                 previous: Union[Color, None] = None):
+        self.address = address
+        self.effect = effect
+        self.started_at = started_at  # wall clock, shared by every mug of a synchronised effect
+        self.interval = interval  # minimum seconds between two writes to this mug
+        self.restore = effect.restore
+        self.previous = previous  # color before any effect, what restore goes back to
+        self.task: Union[asyncio.Task, None] = None
+        self.finished_at: Union[float, None] = None
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def fps(self) -> float:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.written / elapsed if elapsed > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {'effect': self.effect.name, 'running': self.task is not None and not self.task.done(),
+                'written': self.written, 'dropped': self.dropped, 'failed': self.failed, 'fps': self.fps}
+
+
+class Animator:
+    lead = 0.25  # seconds between starting a synchronised effect and its first frame
+
+    def __init__(self):
+        self.playbacks: Dict[str, Playback] = {}
+
+    def play(self, controller: 'Controller', effect: Effect, started_at: Union[float, None] = None,
+             budget: Union[float, None] = None) -> Playback:
+        # budget is writes per second to this mug, by default what its WriteQueue lets through. frames that
+        # don't fit are dropped, never queued, so a busy mug shows the current frame instead of falling behind
+        running = self.playbacks.get(controller.address)
+        previous = running.previous if running is not None and running.finished_at is None else controller.color
+        self.stop(controller.address, restore=False)
+        interval = 1 / budget if budget else controller.writes.min_interval
+        playback = Playback(controller.address, effect, time.time() if started_at is None else started_at, interval,
+                            previous)
+        playback.task = asyncio.ensure_future(self._run(controller, playback))
+        self.playbacks[controller.address] = playback
+        return playback
+
+    def play_fleet(self, controllers: Iterable['Controller'], effect: Effect,
+                   budget: Union[float, None] = None) -> List[Playback]:
+        # every mug is on the same frame at the same time, whatever it was doing before
+        started_at = time.time() + self.lead
+        return [self.play(controller, effect, started_at, budget) for controller in controllers]
+
+    async def _run(self, controller: 'Controller', playback: Playback):
+        effect = playback.effect
+        metrics = controller.metrics
+        shown = -1
+        written_at = float('-inf')
+        writing: Union[asyncio.Future, None] = None
+
+        def done(future: asyncio.Future):
+            if future.cancelled() or not future.result():
+                playback.failed += 1
+
+        try:
+            await asyncio.sleep(max(0.0, playback.started_at - time.time()))
+            while True:
+                now = time.time()
+                number, color = effect.frame(now - playback.started_at)
+                finished = effect.length is not None and number >= effect.length
+                if finished and writing is not None and not writing.done():
+                    await asyncio.shield(writing)  # the final frame must not be dropped
+                if number != shown and now >= written_at + playback.interval \
+                        and (writing is None or writing.done()):
+                    if number - shown > 1:
+                        playback.dropped += number - shown - 1
+                        if metrics is not None:
+                            metrics.inc('ember_animation_frames_dropped_total', number - shown - 1,
+                                        device=playback.address)
+                    writing = controller.queue_color(color)
+                    writing.add_done_callback(done)
+                    shown, written_at = number, now
+                    playback.written += 1
+                    if metrics is not None:
+                        metrics.inc('ember_animation_frames_total', device=playback.address)
+                        metrics.set('ember_animation_fps', playback.fps, device=playback.address)
+                if finished and shown == number:
+                    break
+                due = playback.started_at + effect.next_offset(number)
+                if finished:
+                    wake = written_at + playback.interval
+                elif number != shown and (writing is None or writing.done()):
+                    # the budget held this frame back, it is still worth showing if the budget frees up in time
+                    wake = min(due, written_at + playback.interval)
+                else:
+                    wake = due
+                await asyncio.sleep(max(0.0, wake - time.time()))
+        finally:
+            playback.finished_at = time.time()
+            if metrics is not None:
+                metrics.set('ember_animation_fps', 0.0, device=playback.address)
+            if playback.restore and playback.previous is not None:
+                controller.queue_color(playback.previous)
+
+    def stop(self, address: str, restore=True):
+        # restore=False keeps whatever frame is showing, e.g. when a color is set right after
+        playback = self.playbacks.get(address)
+        if playback is not None and playback.task is not None and not playback.task.done():
+            playback.restore = playback.restore and restore
+            playback.task.cancel()
+
+    def stop_all(self, restore=True):
+        for address in list(self.playbacks):
+            self.stop(address, restore)
+
+    async def wait(self):
+        tasks = [playback.task for playback in self.playbacks.values() if playback.task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, dict]:
+        return {address: playback.stats() for address, playback in self.playbacks.items()}
@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+from PIL import Image, ImageTk
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# images the GUI may show, relative to STATIC_DIR
+GUI_ASSETS = ('background.png', 'icon/heat.png', 'icon/weak_heat.png', 'icon/cool.png', 'icon/weak_cool.png',
+              'icon/normal.png', 'icon/charging.png', 'icon/low.png',
+              'mug/empty.png', 'mug/heating.png', 'mug/complete.png')
+
+
+class AssetRegistry:
+    def __init__(self, root: str = STATIC_DIR):
+        self.root = root
+        # decoded pixels can be shared by every window and produced off the tk thread
+        self.images: Dict[str, Image.Image] = {}
+        # PhotoImage belongs to one tk interpreter, so they are shared per interpreter
+        self.photos: Dict[Tuple[int, str], ImageTk.PhotoImage] = {}
+        self.lock = threading.Lock()
+        self.decode_time = 0.0
+
+    def image(self, path: str) -> Image.Image:
+        with self.lock:
+            image = self.images.get(path)
+            if image is None:
+                started = time.perf_counter()
+                image = Image.open(os.path.join(self.root, path))
+                image.load()
+                self.images[path] = image
+                self.decode_time += time.perf_counter() - started
+            return image
+
+    def photo(self, path: str, master) -> ImageTk.PhotoImage:
+        key = (id(master.tk), path)
+        photo = self.photos.get(key)
+        if photo is None:
+            photo = ImageTk.PhotoImage(self.image(path), master=master)
+            self.photos[key] = photo
+        return photo
+
+    def prewarm(self, paths: Iterable[str] = GUI_ASSETS) -> threading.Thread:
+        # decodes in the background; tk objects are still created lazily on the tk thread
+        paths = list(paths)
+
+        def run():
+            for path in paths:
+                self.image(path)
+
+        thread = threading.Thread(target=run, name='asset-prewarm', daemon=True)
+        thread.start()
+        return thread
+
+
+registry = AssetRegistry()
@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from datetime import datetime
+
+from utils import *
+import codec
+from animation import Animator, pulse
+from controller import Controller
+from fleet import Fleet
+from simulator import SimulatedMug
+
+NO_CACHE = {character: 0 for character in (Request.Temperature, Request.SettingTemperature, Request.State,
+                                           Request.Battery, Request.LightColor, Request.TemperatureScale)}
+
+
+def summary(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'mean': statistics.mean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+async def bench_time_to_snapshot(latency: float, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        mug = SimulatedMug(latency=latency)
+        await mug.connect()
+        controller = Controller(mug, cache_ttl=NO_CACHE)
+        controller.running = True
+        started = time.perf_counter()
+        await controller.initial_fetch_values()
+        samples.append(time.perf_counter() - started)
+        await mug.disconnect()
+    return {'unit': 's', 'latency': latency, **summary(samples)}
+
+
+async def bench_warm_start(latency: float, runs: int) -> dict:
+    # time until state, setting temperature, battery and color are all known, with and without a snapshot of the last run
+    import tempfile
+    from snapshot import SnapshotStore
+
+    useful = ('state', 'setting_temperature', 'battery', 'color')
+
+    async def first_useful_state(snapshots) -> float:
+        mug = SimulatedMug(latency=latency)
+        await mug.connect()
+        started = time.perf_counter()
+        controller = Controller(mug, cache_ttl=NO_CACHE, snapshots=snapshots)
+        task = asyncio.ensure_future(controller.start())
+        while any(getattr(controller, name) is None for name in useful):
+            await asyncio.sleep(0.0005)
+        elapsed = time.perf_counter() - started
+        await controller.quit()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return elapsed
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshots = SnapshotStore(os.path.join(directory, 'snapshots.json'))
+        cold = [await first_useful_state(None) for _ in range(runs)]
+        await first_useful_state(snapshots)  # leaves a snapshot behind
+        warm = [await first_useful_state(SnapshotStore(snapshots.path)) for _ in range(runs)]
+    return {'unit': 's', 'latency': latency, 'cold': summary(cold), 'warm': summary(warm)}
+
+
+async def bench_notification_latency(latency: float, runs: int) -> dict:
+    mug = SimulatedMug(latency=latency)
+    await mug.connect()
+    controller = Controller(mug, cache_ttl=NO_CACHE)
+    controller.running = True
+    callback = controller.notify_callback()
+    await mug.start_notify(Request.Notification.as_uuid, callback)
+
+    samples = []
+    changed = asyncio.Event()
+    controller.subscribe(lambda name, value: name == 'temperature' and changed.set())
+    for i in range(runs):
+        changed.clear()
+        mug.temperature = 40.0 + (i % 2)
+        started = time.perf_counter()
+        mug.emit(NotificationValue.TemperatureChange)
+        await changed.wait()
+        samples.append(time.perf_counter() - started)
+    await mug.disconnect()
+    return {'unit': 's', 'latency': latency, **summary(samples)}
+
+
+async def bench_gatt_throughput(latency: float, sizes: list, duration: float) -> dict:
+    results = {}
+    for size in sizes:
+        fleet = Fleet()
+        mugs = [SimulatedMug('SIM:{:05d}'.format(i), latency=latency) for i in range(size)]
+        for mug in mugs:
+            await mug.connect()
+            fleet.add(mug).cache.ttl.update(NO_CACHE)
+
+        async def hammer(controller: Controller, deadline: float):
+            while time.perf_counter() < deadline:
+                await controller.scheduler.read(Request.Temperature)
+
+        # a full pipeline per controller. the readers go to the scheduler, the cache would merge identical reads
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(hammer(controller, deadline) for controller in fleet
+                               for _ in range(controller.scheduler.depth)))
+        operations = sum(mug.reads for mug in mugs)
+        results[str(size)] = {
+            'max_in_flight': fleet.max_in_flight,
+            'ops_per_sec': operations / duration,
+            'ops_per_sec_per_controller': operations / duration / size,
+        }
+        for mug in mugs:
+            await mug.disconnect()
+    return {'unit': 'ops/s', 'latency': latency, 'fleet': results}
+
+
+async def bench_animation(latency: float, sizes: list, max_in_flight: int = 8) -> dict:
+    # one synchronised pulse across the fleet. once the adapter is the bottleneck, frames are dropped
+    results = {}
+    for size in sizes:
+        fleet = Fleet(max_in_flight)
+        mugs = [SimulatedMug('SIM:{:05d}'.format(i), latency=latency) for i in range(size)]
+        for mug in mugs:
+            await mug.connect()
+            fleet.add(mug)
+        animator = Animator()
+        effect = pulse(Color(255, 128, 0), period=2.0, repeat=2)
+        animator.play_fleet(fleet, effect)
+        await animator.wait()
+        stats = animator.stats().values()
+        results[str(size)] = {
+            'frames': effect.length + 1,
+            'fps': summary([playback['fps'] for playback in stats]),
+            'dropped_per_mug': sum(playback['dropped'] for playback in stats) / size,
+        }
+        for controller in fleet:
+            await controller.writes.flush()
+        for mug in mugs:
+            await mug.disconnect()
+    return {'unit': 'frames/s', 'latency': latency, 'max_in_flight': max_in_flight, 'fleet': results}
+
+
+def bench_update_frame(runs: int) -> dict:
+    try:
+        import tkinter as tk
+        from assets import AssetRegistry
+        from gui import Application
+        root = tk.Tk()
+    except Exception as e:  # no display, or GUI requirements not installed
+        return {'skipped': repr(e)}
+
+    def startup(prewarm: bool) -> float:
+        assets = AssetRegistry()
+        if prewarm:
+            assets.prewarm().join()
+        window = tk.Toplevel(root)
+        application = Application(Controller(SimulatedMug()), master=window, assets=assets)
+        window.destroy()
+        return application.startup_time
+
+    controller = Controller(SimulatedMug())
+    application = Application(controller, master=tk.Toplevel(root))
+    full, single = [], []
+    for i in range(runs):
+        controller.temperature = 50.0 + i % 10
+        controller.setting_temperature = 55.0
+        controller.battery = BatteryState(50 + i % 40, bool(i % 2))
+        controller.state = State.Heating if i % 2 else State.Keeping
+        controller.color = Color(i % 256, 0, 0)
+        application.dirty.update(controller.observed)
+        started = time.perf_counter()
+        application.update_()
+        full.append(time.perf_counter() - started)
+
+        controller.temperature = 60.0 + i % 10
+        started = time.perf_counter()
+        application.update_()
+        single.append(time.perf_counter() - started)
+
+    result = {
+        'unit': 's',
+        'full_repaint': summary(full),
+        'temperature_only': summary(single),
+        'startup_cold': startup(False),
+        'startup_prewarmed': startup(True),
+    }
+    root.destroy()
+    return result
+
+
+async def ble_side(latency: float, duration: float) -> dict:
+    # temperature notifications of a simulated mug, and how late the event loop wakes up meanwhile
+    mug = SimulatedMug(latency=latency)
+    await mug.connect()
+    controller = Controller(mug, cache_ttl=NO_CACHE, metrics=None)
+    controller.running = True
+    await mug.start_notify(Request.Notification.as_uuid, controller.notify_callback())
+    changed = asyncio.Event()
+    controller.subscribe(lambda name, value: name == 'temperature' and changed.set())
+
+    notifications, lag = [], []
+    deadline = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < deadline:
+        expected = time.perf_counter() + 0.05
+        await asyncio.sleep(0.05)
+        lag.append(max(0.0, time.perf_counter() - expected))
+
+        changed.clear()
+        mug.temperature = 40.0 + i % 2
+        i += 1
+        started = time.perf_counter()
+        mug.emit(NotificationValue.TemperatureChange)
+        await changed.wait()
+        notifications.append(time.perf_counter() - started)
+    await mug.disconnect()
+    return {'notification_latency': summary(notifications), 'loop_lag': summary(lag)}
+
+
+def bench_bridge(latency: float, duration: float) -> dict:
+    # a ui callback blocks for 0.2 s once a second, like the askcolor dialog does.
+    # pumped: tk updates run as a coroutine on the BLE loop, as before the bridge. bridged: tk keeps its own thread
+    def ui_frame(frame: int):
+        if frame % 15 == 0:
+            time.sleep(0.2)
+
+    async def pumped():
+        async def updater(deadline: float):
+            frame = 0
+            while time.perf_counter() < deadline:
+                ui_frame(frame)
+                frame += 1
+                await asyncio.sleep(1 / 15)
+
+        result, _ = await asyncio.gather(ble_side(latency, duration), updater(time.perf_counter() + duration))
+        return result
+
+    before = asyncio.run(pumped())
+
+    from bridge import LoopBridge
+    bridge = LoopBridge().start()
+    future = bridge.submit(ble_side(latency, duration))
+    frame = 0
+    while not future.done():
+        ui_frame(frame)
+        bridge.drain()
+        frame += 1
+        time.sleep(1 / 15)
+    after = future.result()
+    bridge.stop()
+    return {'unit': 's', 'latency': latency, 'pumped': before, 'bridged': after}
+
+
+# what library, GUI and entry point users pay before doing anything. python alone is the baseline
+IMPORTS = (('python', 'pass'), ('utils', 'import utils'), ('controller', 'import controller'),
+           ('gui', 'import gui'), ('main', 'import main'))
+
+IMPORT_SCRIPT = '''
+import json, resource, sys, time
+started = time.perf_counter()
+{}
+elapsed = time.perf_counter() - started
+try:  # linux keeps ru_maxrss of the forking parent, VmHWM starts over with the new interpreter
+    with open('/proc/self/status') as f:
+        rss = int(next(line for line in f if line.startswith('VmHWM')).split()[1])
+except OSError:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+print(json.dumps([elapsed, rss]))
+'''
+
+
+def bench_imports(runs: int) -> dict:
+    # every import runs in a fresh interpreter, rss is its peak resident size in kilobytes
+    results = {}
+    for name, statement in IMPORTS:
+        seconds, rss = [], []
+        for _ in range(runs):
+            process = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(statement)], capture_output=True,
+                                     text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            if process.returncode != 0:
+                results[name] = {'skipped': process.stderr.strip().splitlines()[-1]}
+                break
+            elapsed, maxrss = json.loads(process.stdout)
+            seconds.append(elapsed)
+            rss.append(maxrss)
+        else:
+            results[name] = {'import_seconds': summary(seconds), 'max_rss_kb': statistics.median(rss)}
+    return {'unit': 's', **results}
+
+
+def bench_codec(number: int) -> dict:
+    temperature = bytearray(b'\x92\t')
+    battery = bytearray([80, 1])
+    color = bytearray([255, 186, 46, 255])
+    results = {}
+    for name, func, value in (('decode_temperature', decode_temperature, temperature),
+                              ('parse_battery', parse_battery, battery),
+                              ('parse_color', parse_color, color),
+                              ('codec.decode_battery', codec.decode_battery, battery)):
+        seconds = min(timeit.repeat(lambda: func(value), number=number, repeat=3))
+        results[name] = {'calls_per_sec': number / seconds, 'ns_per_call': seconds / number * 1e9}
+
+    frames = [bytes(temperature)] * 10000
+    seconds = min(timeit.repeat(lambda: codec.decode_temperatures(frames), number=max(1, number // 10000), repeat=3))
+    results['codec.decode_temperatures'] = {'calls_per_sec': max(1, number // 10000) * 10000 / seconds,
+                                            'ns_per_call': seconds / (max(1, number // 10000) * 10000) * 1e9}
+    return {'unit': 'calls/s', **results}
+
+
+async def run(args) -> dict:
+    def wanted(name: str) -> bool:
+        return not args.only or name in args.only
+
+    results = {}
+    if wanted('time_to_snapshot'):
+        results['time_to_snapshot'] = await bench_time_to_snapshot(args.latency, args.runs)
+    if wanted('warm_start'):
+        results['warm_start'] = await bench_warm_start(args.latency, args.runs)
+    if wanted('notification_latency'):
+        results['notification_latency'] = await bench_notification_latency(args.latency, args.runs)
+    if wanted('gatt_throughput'):
+        results['gatt_throughput'] = await bench_gatt_throughput(args.latency, args.fleet_sizes, args.duration)
+    if wanted('animation'):
+        results['animation'] = await bench_animation(args.latency, args.fleet_sizes)
+    if wanted('update_frame'):
+        results['update_frame'] = bench_update_frame(args.runs)
+    if wanted('bridge'):
+        results['bridge'] = await asyncio.get_event_loop().run_in_executor(None, bench_bridge, args.latency,
+                                                                           args.duration)
+    if wanted('codec'):
+        results['codec'] = bench_codec(args.number)
+    if wanted('imports'):
+        results['imports'] = bench_imports(min(args.runs, 10))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark controller hot paths against simulated mugs.')
+    parser.add_argument('--latency', type=float, default=0.01, help='simulated GATT round-trip in seconds')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per throughput measurement')
+    parser.add_argument('--fleet-sizes', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--number', type=int, default=100000, help='calls per codec measurement')
+    parser.add_argument('--only', nargs='+', help='run only these benchmarks, e.g. imports codec')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': asyncio.run(run(args)),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
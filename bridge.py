@@ -0,0 +1,102 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Deque, Union
+
+
+def summarize(samples: Deque[float]) -> dict:
+    # milliseconds
+    if not samples:
+        return {'n': 0, 'mean_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+    ordered = sorted(samples)
+    return {'n': len(ordered), 'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            'max_ms': ordered[-1] * 1000}
+
+
+class LoopBridge:
+    probe_interval = 0.05  # seconds between two measurements of event loop lag
+
+    def __init__(self):
+        # asyncio runs on its own thread, tk keeps the main thread. neither calls into the other directly:
+        # commands go to the loop with call_soon_threadsafe, events come back through a queue drained by tk
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='asyncio', daemon=True)
+        self.events: 'queue.SimpleQueue' = queue.SimpleQueue()
+
+        # seconds a command waited for the loop, an event waited for tk, and how late the loop and tk woke up
+        self.command_latency: Deque[float] = deque(maxlen=1000)
+        self.event_latency: Deque[float] = deque(maxlen=1000)
+        self.loop_lag: Deque[float] = deque(maxlen=1000)
+        self.ui_lag: Deque[float] = deque(maxlen=1000)
+
+    def start(self) -> 'LoopBridge':
+        self.thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._probe())
+        try:
+            self.loop.run_forever()
+        finally:
+            # like asyncio.run, whatever is still running is cancelled before the loop is closed
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def _probe(self):
+        while True:
+            expected = time.perf_counter() + self.probe_interval
+            await asyncio.sleep(self.probe_interval)
+            self.loop_lag.append(max(0.0, time.perf_counter() - expected))
+
+    def stop(self, timeout: float = 5.0):
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+
+    # ui -> asyncio
+
+    def call(self, func: Callable, *args):
+        # fire and forget, e.g. controller.queue_color from a button handler
+        posted = time.perf_counter()
+
+        def run():
+            self.command_latency.append(time.perf_counter() - posted)
+            func(*args)
+
+        self.loop.call_soon_threadsafe(run)
+
+    def submit(self, coroutine: Awaitable) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Awaitable, timeout: Union[float, None] = None):
+        # blocks the calling thread, never call it from the loop thread
+        return self.submit(coroutine).result(timeout)
+
+    # asyncio -> ui
+
+    def post(self, func: Callable, *args):
+        self.events.put((time.perf_counter(), func, args))
+
+    def drain(self) -> int:
+        # runs the posted events on the calling (ui) thread
+        handled = 0
+        while True:
+            try:
+                posted, func, args = self.events.get_nowait()
+            except queue.Empty:
+                return handled
+            self.event_latency.append(time.perf_counter() - posted)
+            func(*args)
+            handled += 1
+
+    def stats(self) -> dict:
+        return {'command_latency': summarize(self.command_latency), 'event_latency': summarize(self.event_latency),
+                'loop_lag': summarize(self.loop_lag), 'ui_lag': summarize(self.ui_lag)}
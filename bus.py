@@ -0,0 +1,101 @@
+import asyncio
+import inspect
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Union
+from warnings import warn
+
+from utils import NotificationValue
+from metrics import Metrics
+
+Handler = Callable[[NotificationValue], object]
+
+
+class NotificationBus:
+    def __init__(self, maxsize: int = 8, metrics: Union[Metrics, None] = None, device: str = ''):
+        # pending notifications of one device. a notification that is already pending is coalesced into it,
+        # so a burst of TemperatureChange results in one dispatch
+        self.maxsize = maxsize
+        self.pending: 'OrderedDict[NotificationValue, None]' = OrderedDict()
+        self.handlers: Dict[Union[NotificationValue, None], List[Handler]] = {}
+        self.worker: Union[asyncio.Task, None] = None
+
+        self.metrics = metrics
+        self.device = device
+        self.histograms = {}
+
+        self.published = 0
+        self.dispatched = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.peak_depth = 0
+
+    def subscribe(self, handler: Handler, *notifications: NotificationValue):
+        # handler(notification) may return an awaitable. without notifications it receives every notification
+        for notification in notifications or (None,):
+            self.handlers.setdefault(notification, []).append(handler)
+
+    def unsubscribe(self, handler: Handler, *notifications: NotificationValue):
+        for notification in notifications or list(self.handlers):
+            handlers = self.handlers.get(notification, [])
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def publish(self, notification: NotificationValue) -> bool:
+        # never blocks the Bluetooth callback. returns False when the notification was dropped
+        self.published += 1
+        if notification in self.pending:
+            self.coalesced += 1
+            self._count('ember_notifications_coalesced_total', notification)
+            return True
+        if len(self.pending) >= self.maxsize:
+            self.dropped += 1
+            self._count('ember_notifications_dropped_total', notification)
+            return False
+        self.pending[notification] = None
+        self.peak_depth = max(self.peak_depth, len(self.pending))
+        self._set_depth()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self._drain())
+        return True
+
+    async def _drain(self):
+        while self.pending:
+            notification, _ = self.pending.popitem(last=False)
+            self._set_depth()
+            started = time.perf_counter()
+            for handler in self.handlers.get(notification, []) + self.handlers.get(None, []):
+                try:
+                    result = handler(notification)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:  # one failing subscriber must not stop the others
+                    self.failed += 1
+                    warn(f'handling {notification.name} failed: {e!r}')
+            self.dispatched += 1
+            if self.metrics is not None:
+                histogram = self.histograms.get(notification)
+                if histogram is None:
+                    histogram = self.histograms[notification] = self.metrics.histogram(
+                        'ember_notification_seconds', device=self.device, notification=notification.name)
+                histogram.observe(time.perf_counter() - started)
+
+    def _count(self, name: str, notification: NotificationValue):
+        if self.metrics is not None:
+            self.metrics.inc(name, device=self.device, notification=notification.name)
+
+    def _set_depth(self):
+        if self.metrics is not None:
+            self.metrics.set('ember_notification_queue_depth', len(self.pending), device=self.device)
+
+    def close(self):
+        self.pending.clear()
+        self._set_depth()
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def stats(self) -> dict:
+        return {'published': self.published, 'dispatched': self.dispatched, 'coalesced': self.coalesced,
+                'dropped': self.dropped, 'failed': self.failed, 'depth': len(self.pending),
+                'peak_depth': self.peak_depth}
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Tuple, Union
+
+from utils import Character, NotificationValue, Request
+
+# seconds a read value stays valid. writes and notifications invalidate entries earlier
+DEFAULT_TTL = {
+    Request.Temperature: 1.0,
+    Request.SettingTemperature: 0.5,
+    Request.State: 0.5,
+    Request.Battery: 10.0,
+    Request.LightColor: 30.0,
+    Request.TemperatureScale: 30.0,
+}
+
+# characteristics whose cached value is outdated once the notification arrives
+NOTIFICATION_INVALIDATES = {
+    NotificationValue.BatteryChargeChange: (Request.Battery,),
+    NotificationValue.OnCoaster: (Request.Battery, Request.State),
+    NotificationValue.OffCoaster: (Request.Battery, Request.State),
+    NotificationValue.TemperatureChange: (Request.Temperature,),
+    NotificationValue.Poured: (Request.State, Request.SettingTemperature, Request.Temperature),
+    NotificationValue.HeatingStateChange: (Request.State, Request.Temperature),
+}
+
+
+class ReadCache:
+    def __init__(self, ttl: Union[Dict[Character, float], None] = None):
+        self.ttl = dict(DEFAULT_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+
+        self.entries: Dict[Character, Tuple[float, bytearray]] = {}
+        self.pending: Dict[Character, asyncio.Task] = {}
+        # bumped on invalidation, so a read that started before it is never stored
+        self.generations: Dict[Character, int] = {}
+
+        self.hits: Dict[Character, int] = {}
+        self.misses: Dict[Character, int] = {}
+        self.shared: Dict[Character, int] = {}  # reads that joined an identical one already in flight
+
+    async def get(self, character: Character, fetch: Callable[[], Awaitable[bytearray]]) -> bytearray:
+        entry = self.entries.get(character)
+        if entry is not None and time.monotonic() < entry[0]:
+            self.hits[character] = self.hits.get(character, 0) + 1
+            return entry[1]
+
+        task = self.pending.get(character)
+        if task is not None:
+            self.shared[character] = self.shared.get(character, 0) + 1
+            return await asyncio.shield(task)
+
+        self.misses[character] = self.misses.get(character, 0) + 1
+        generation = self.generations.get(character, 0)
+        task = asyncio.ensure_future(fetch())
+        # the exception is re-raised to every waiter. this only keeps asyncio from complaining when none is left
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.pending[character] = task
+        try:
+            value = await asyncio.shield(task)
+        finally:
+            if self.pending.get(character) is task:
+                del self.pending[character]
+
+        ttl = self.ttl.get(character, 0)
+        if ttl > 0 and self.generations.get(character, 0) == generation:
+            self.entries[character] = (time.monotonic() + ttl, value)
+        return value
+
+    def invalidate(self, characters: Iterable[Character]):
+        for character in characters:
+            self.entries.pop(character, None)
+            self.pending.pop(character, None)
+            self.generations[character] = self.generations.get(character, 0) + 1
+
+    def invalidate_for(self, notification: NotificationValue):
+        self.invalidate(NOTIFICATION_INVALIDATES.get(notification, ()))
+
+    def clear(self):
+        self.invalidate(set(self.entries) | set(self.pending))
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        shared = sum(self.shared.values())
+        total = hits + misses + shared
+        return {
+            'hits': hits,
+            'misses': misses,
+            'shared': shared,
+            'hit_ratio': (hits + shared) / total if total else 0.0,
+            'characteristics': {
+                character.name: {'hits': self.hits.get(character, 0),
+                                 'misses': self.misses.get(character, 0),
+                                 'shared': self.shared.get(character, 0)}
+                for character in set(self.hits) | set(self.misses) | set(self.shared)
+            },
+        }
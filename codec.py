@@ -0,0 +1,129 @@
+import sys
+from array import array
+from typing import Callable, Dict, Iterable, Tuple
+
+from utils import *
+
+CHARACTERISTICS = (Request.Temperature, Request.SettingTemperature, Request.TemperatureScale, Request.Battery,
+                   Request.Notification, Request.State, Request.LightColor)
+
+# precomputed lookups, BLE stacks report either the full uuid (in any case) or the short handle
+BY_UUID: Dict[str, Character] = {character.uuid.lower(): character for character in CHARACTERISTICS}
+BY_UUID.update({character.uuid: character for character in CHARACTERISTICS})
+BY_HANDLE: Dict[int, Character] = {character.characteristics: character for character in CHARACTERISTICS}
+
+# battery states are few and immutable in practice, so decoding reuses one object per value
+BATTERY_STATES = [[BatteryState(charge, bool(charging)) for charging in (0, 1)] for charge in range(256)]
+
+
+def lookup(uuid_or_handle) -> Character:
+    if isinstance(uuid_or_handle, int):
+        return BY_HANDLE[uuid_or_handle]
+    uuid = str(uuid_or_handle)
+    character = BY_UUID.get(uuid)
+    return character if character is not None else BY_UUID[uuid.lower()]
+
+
+def decode_battery(value: bytearray) -> BatteryState:
+    return BATTERY_STATES[value[0]][1 if value[1] else 0]
+
+
+def decode_state(value: bytearray) -> State:
+    return State(value[0])
+
+
+def decode_scale(value: bytearray) -> TemperatureScale:
+    return TemperatureScale(value[0])
+
+
+def decode_notification(value: bytearray) -> NotificationValue:
+    return NotificationValue(value[0])
+
+
+def encode_battery(value: BatteryState) -> bytearray:
+    return bytearray(BATTERY_STRUCT.pack(value.battery_charge, int(value.is_charging)))
+
+
+def encode_state(value: State) -> bytearray:
+    return bytearray(BYTE_STRUCT.pack(value.value))
+
+
+DECODERS: Dict[Character, Callable[[bytearray], object]] = {
+    Request.Temperature: decode_temperature,
+    Request.SettingTemperature: decode_temperature,
+    Request.TemperatureScale: decode_scale,
+    Request.Battery: decode_battery,
+    Request.Notification: decode_notification,
+    Request.State: decode_state,
+    Request.LightColor: parse_color,
+}
+
+ENCODERS: Dict[Character, Callable[[object], bytearray]] = {
+    Request.Temperature: encode_temperature,
+    Request.SettingTemperature: encode_temperature,
+    Request.TemperatureScale: lambda scale: scale.as_bytearray,
+    Request.Battery: encode_battery,
+    Request.State: encode_state,
+    Request.LightColor: lambda color: color.as_bytearray,
+}
+
+
+def decode(character: Character, value: bytearray):
+    return DECODERS[character](value)
+
+
+def encode(character: Character, value) -> bytearray:
+    return ENCODERS[character](value)
+
+
+# batch decoding. payloads are joined once and converted with array, without an object per sample
+
+def _joined(payloads) -> bytes:
+    if isinstance(payloads, (bytes, bytearray, memoryview)):
+        return bytes(payloads)
+    return b''.join(payloads)
+
+
+def decode_temperatures(payloads) -> array:
+    # payloads: iterable of 2 byte frames, or one contiguous buffer of them. returns 1/100 °C like the wire, scaling
+    # to °C here would make a float per sample; analytics.decode_temperatures does it vectorized
+    raw = array('H')
+    raw.frombytes(_joined(payloads))
+    if sys.byteorder == 'big':
+        raw.byteswap()
+    return raw
+
+
+def decode_batteries(payloads) -> Tuple[array, array]:
+    # returns (charge %, charging flag)
+    data = _joined(payloads)
+    return array('B', data[0::2]), array('B', data[1::2])
+
+
+def decode_states(payloads) -> array:
+    # state codes, see utils.State
+    return array('B', _joined(payloads))
+
+
+def decode_colors(payloads) -> array:
+    # packed 0xAABBGGRR per color, as read from the little endian wire order
+    raw = array('I')
+    raw.frombytes(_joined(payloads))
+    if sys.byteorder == 'big':
+        raw.byteswap()
+    return raw
+
+
+BATCH_DECODERS = {
+    Request.Temperature: decode_temperatures,
+    Request.SettingTemperature: decode_temperatures,
+    Request.Battery: decode_batteries,
+    Request.State: decode_states,
+    Request.TemperatureScale: decode_states,
+    Request.Notification: decode_states,
+    Request.LightColor: decode_colors,
+}
+
+
+def decode_many(character: Character, payloads: Iterable[bytes]):
+    return BATCH_DECODERS[character](payloads)
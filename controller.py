@@ -1,13 +1,24 @@
 import asyncio
-import tkinter as tk
-from typing import Union
-from bleak import discover, BleakClient
+import sys
+import time
+from typing import Callable, Dict, List, Set, Union
 from bleak.exc import BleakError
-from datetime import datetime, timedelta
-from plyer import notification
+from datetime import datetime
 from functools import wraps
 from warnings import warn
 from utils import *
+from codec import decode_battery
+from scheduler import RequestScheduler, WriteQueue
+from cache import ReadCache
+from prediction import Predictor
+from bus import NotificationBus
+from metrics import Metrics, registry as metrics_registry
+
+
+def count_swallowed(controller, func):
+    metrics = getattr(controller, 'metrics', None)
+    if metrics is not None:
+        metrics.inc('ember_swallowed_errors_total', device=controller.address, function=func.__name__)
 
 
 def ble_error_catch(func):
@@ -17,6 +28,7 @@ def ble_error_catch(func):
             try:
                 return await func(self, *args, **kwargs)
             except (RuntimeError, BleakError):
+                count_swallowed(self, func)
                 warn(f"'{func.__name__}' was failed because of Bluetooth error.")
         return async_inner
 
@@ -26,15 +38,51 @@ def ble_error_catch(func):
             try:
                 return func(self, *args, **kwargs)
             except (RuntimeError, BleakError):
+                count_swallowed(self, func)
                 warn(f"'{func.__name__}' was failed because of Bluetooth error.")
         return inner
 
 
 class Controller:
-    notify_interval = 180  # won't notify until after 180 seconds from last notification
-
-    def __init__(self, client: BleakClient, notify_when_complete=False):
+    notify_interval = 180  # won't notify until after 180 seconds from last notification of this mug
+    poll_interval = 1  # seconds between State/SettingTemperature polls
+    fallback_interval = 30  # safety-net poll in event driven mode
+    max_poll_interval = 30  # longest adaptive poll while the predictor expects no state change
+    pipeline_depth = 4  # concurrent GATT requests per connection
+    min_write_interval = 0.25  # seconds between two queued writes
+
+    # read together by initial_fetch_values. SettingTemperature precedes State, which depends on it
+    snapshot_characteristics = (Request.SettingTemperature, Request.State, Request.LightColor,
+                                Request.TemperatureScale, Request.Temperature, Request.Battery)
+
+    notification_queue_size = 8  # distinct notifications waiting per mug, more are dropped
+
+    # notifications after which State has to be re-read in event driven mode
+    state_notifications = (NotificationValue.HeatingStateChange, NotificationValue.Poured,
+                           NotificationValue.OnCoaster, NotificationValue.OffCoaster)
+
+    # attributes whose changes are published to subscribers
+    observed = ('battery', 'temperature', 'setting_temperature', 'state', 'color', 'temperature_scale')
+
+    # attribute each characteristic is decoded into
+    attributes = {Request.Battery: 'battery', Request.Temperature: 'temperature',
+                  Request.SettingTemperature: 'setting_temperature', Request.State: 'state',
+                  Request.LightColor: 'color', Request.TemperatureScale: 'temperature_scale'}
+
+    def __init__(self, client: 'BleakClient', notify_when_complete=False,
+                 gatt_limit: Union[asyncio.Semaphore, None] = None, event_driven=False,
+                 pipeline_depth: Union[int, None] = None, cache_ttl: Union[Dict[Character, float], None] = None,
+                 metrics: Union[Metrics, None] = metrics_registry, adaptive=True, notifier: Union['Notifier', None] = None,
+                 snapshots: Union['SnapshotStore', None] = None):
+        self.listeners: List[Callable[[str, object], None]] = []
         self.client = client
+        # gatt_limit is shared by every controller of a Fleet to bound in-flight GATT operations
+        self.metrics = metrics
+        self.scheduler = RequestScheduler(client, pipeline_depth or self.pipeline_depth, gatt_limit, metrics)
+        self.cache = ReadCache(cache_ttl)
+        self.writes = WriteQueue(self._write, self.min_write_interval)
+        # notifications are queued and dispatched outside the Bluetooth callback, see register_notification_handlers
+        self.bus = NotificationBus(self.notification_queue_size, metrics, getattr(client, 'address', ''))
 
         self.battery: Union[BatteryState, None] = None
         self.temperature: Union[float, None] = None
@@ -44,144 +92,297 @@ class Controller:
         self.temperature_scale = TemperatureScale.Celsius
 
         self.notify_when_complete = notify_when_complete
+        # notifier.desktop unless given, imported only once a drink is ready
+        self.notifier = notifier
         self.last_notify: Union[datetime, None] = None
 
+        self.event_driven = event_driven
+        # polls are spaced out by the predicted time to Keeping instead of every poll_interval
+        self.adaptive = adaptive
+        self.predictor = Predictor()
+        self.predictor.attach(self)
+        # State/SettingTemperature reads issued by set_schedule and by notifications,
+        # and the number of poll_interval ticks they are compared against
+        self.poll_reads = 0
+        self.event_reads = 0
+        self.poll_ticks = 0
+
+        self.started_at: Union[float, None] = None
+        self.time_to_first_snapshot: Union[float, None] = None
+
         self.running = False
+        self.closed = False  # set by quit(), as opposed to a lost connection
+
+        # values of the last run are shown right away, and stay stale until they are read again
+        self.stale: Set[str] = set()
+        self.snapshots = snapshots
+        if snapshots is not None:
+            from snapshot import PERSISTED
+            self.persisted = PERSISTED
+            for name, value in snapshots.get(self.address).items():
+                setattr(self, name, value)
+                self.stale.add(name)
+            self.subscribe(self.persist)
 
-        self.gui: Union[tk.Frame, None] = None
+        self.register_notification_handlers()
 
     async def start(self):
         self.running = True
+        self.started_at = time.monotonic()
 
         # write value to turn off Ember's bluetooth led
-        await self.client.write_gatt_char(Request.TemperatureScale.as_uuid,
-                                          await self.client.read_gatt_char(Request.TemperatureScale.as_uuid))
+        await self._write(Request.TemperatureScale, await self._read(Request.TemperatureScale))
 
         await self.client.start_notify(Request.Notification.as_uuid, self.notify_callback())
 
         await asyncio.gather(self.set_schedule(), self.initial_fetch_values())
 
-    async def start_with_gui(self, frame: tk.Frame):
-        self.running = True
-
-        self.gui = frame
-
-        await self.client.start_notify(Request.Notification.as_uuid, self.notify_callback())
-        await self.client.write_gatt_char(Request.TemperatureScale.as_uuid,
-                                          await self.client.read_gatt_char(Request.TemperatureScale.as_uuid))
-
-        await asyncio.gather(self.set_schedule(), self.initial_fetch_values(True))
+    def __setattr__(self, name, value):
+        if name not in self.observed:
+            return super().__setattr__(name, value)
+        old = self.__dict__.get(name)
+        super().__setattr__(name, value)
+        if old != value:
+            for listener in self.listeners:
+                listener(name, value)
+
+    def subscribe(self, listener: Callable[[str, object], None]):
+        # listener(name, value) is called whenever one of `observed` changes
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[str, object], None]):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def attach(self, client: 'BleakClient'):
+        # continue on a new connection to the same mug, keeping values and pending writes
+        self.client = client
+        self.scheduler = RequestScheduler(client, self.scheduler.depth, self.scheduler.gatt_limit, self.metrics)
+        self.cache.clear()
+
+    def persist(self, name: str, value):
+        if name in self.persisted:
+            self.snapshots.update(self.address, name, value)
+
+    @property
+    def address(self) -> str:
+        return self.client.address
+
+    def as_dict(self) -> dict:
+        return {
+            'address': self.address,
+            'running': self.running,
+            'state': self.state.name if self.state is not None else None,
+            'temperature': self.temperature,
+            'setting_temperature': self.setting_temperature,
+            'temperature_scale': self.temperature_scale.name,
+            'battery': self.battery.battery_charge if self.battery is not None else None,
+            'charging': self.battery.is_charging if self.battery is not None else None,
+            'color': self.color.as_rgba if self.color is not None else None,
+            'time_to_target': self.predictor.time_to_target(),
+            'stale': sorted(self.stale),
+        }
+
+    async def _read(self, character: Character) -> bytearray:
+        return await self.cache.get(character, lambda: self.scheduler.read(character))
+
+    async def _write(self, character: Character, data: bytearray):
+        self.cache.invalidate((character,))
+        return await self.scheduler.write(character, data)
+
+    async def _apply(self, character: Character, value: bytearray):
+        if character is Request.Battery:
+            self.battery = decode_battery(value)
+        elif character is Request.Temperature:
+            self.temperature = decode_temperature(value)
+        elif character is Request.SettingTemperature:
+            if not self.writes.is_pending(character):  # don't let a poll revert a value about to be written
+                self.setting_temperature = decode_temperature(value)
+        elif character is Request.State:
+            state = State(value[0])
+            if state == State.Poured:
+                self.queue_setting_temperature(max(self.setting_temperature or 0, 50.0))
+            # a Keeping state restored from the last run doesn't count as being ready already
+            if state == State.Keeping and (self.state != State.Keeping or 'state' in self.stale) and \
+                    self.notify_when_complete:
+                self.notify()
+            self.state = state
+        elif character is Request.LightColor:
+            if not self.writes.is_pending(character):
+                self.color = parse_color(value)
+        elif character is Request.TemperatureScale:
+            if not self.writes.is_pending(character):
+                self.temperature_scale = TemperatureScale(value[0])
+
+        name = self.attributes.get(character)
+        if name in self.stale:
+            self.stale.discard(name)
+            for listener in self.listeners:
+                listener('stale', frozenset(self.stale))
 
     def notify(self):
-        last = self.last_notify
-        self.last_notify = datetime.now()
-        if last is not None and last > datetime.now() - timedelta(seconds=self.notify_interval):
-            return
-
         if self.temperature_scale == TemperatureScale.Celsius:
             temp = '{}°C'.format(self.setting_temperature)
         else:
             temp = '{}°F'.format(int(TemperatureConversion.c2f(self.setting_temperature)))
-        notification.notify(title='Your Drink is Waiting For You!',
-                            message='Your drink is waiting for you to drink!. It\'s nice and warm {}!'.format(temp),
-                            app_name='Ember Mug Controller')
+        # delivered by the notifier's worker thread, rate limited per mug and across mugs
+        if self.notifier is None:
+            from notifier import desktop
+            self.notifier = desktop
+        if self.notifier.drink_ready(self.address, temp, self.notify_interval):
+            self.last_notify = datetime.now()
 
     @ble_error_catch
     async def fetch_battery_state(self):
-        value = await self.client.read_gatt_char(Request.Battery.as_uuid)
-        self.battery = parse_battery(value)
+        await self._apply(Request.Battery, await self._read(Request.Battery))
 
     @ble_error_catch
     async def fetch_temperature(self):
-        value = await self.client.read_gatt_char(Request.Temperature.as_uuid)
-        self.temperature = decode_temperature(value)
+        await self._apply(Request.Temperature, await self._read(Request.Temperature))
 
     @ble_error_catch
     async def fetch_setting_temperature(self):
-        value = await self.client.read_gatt_char(Request.SettingTemperature.as_uuid)
-        self.setting_temperature = decode_temperature(value)
+        await self._apply(Request.SettingTemperature, await self._read(Request.SettingTemperature))
 
-    @ble_error_catch
-    async def set_setting_temperature(self, value: float):
-        await self.client.write_gatt_char(Request.SettingTemperature.as_uuid, encode_temperature(value))
+    def queue_setting_temperature(self, value: float) -> asyncio.Future:
+        # applied locally right away, written behind together with other pending writes
         self.setting_temperature = value
+        return self.writes.submit(Request.SettingTemperature, encode_temperature(value))
+
+    async def set_setting_temperature(self, value: float):
+        await self.queue_setting_temperature(value)
 
     @ble_error_catch
     async def fetch_state(self):
-        value = await self.client.read_gatt_char(Request.State.as_uuid)
-        state = State(value[0])
-        if state == State.Poured:
-            await self.set_setting_temperature(max(self.setting_temperature, 50.0))
-        if state == State.Keeping and self.state != State.Keeping and self.notify_when_complete:
-            self.notify()
-        self.state = state
+        await self._apply(Request.State, await self._read(Request.State))
 
     @ble_error_catch
     async def fetch_color(self):
-        value = await self.client.read_gatt_char(Request.LightColor.as_uuid)
-        self.color = parse_color(value)
+        await self._apply(Request.LightColor, await self._read(Request.LightColor))
 
-    @ble_error_catch
-    async def set_color(self, color: Color):
-        await self.client.write_gatt_char(Request.LightColor.as_uuid, color.as_bytearray)
+    def queue_color(self, color: Color) -> asyncio.Future:
+        data = color.as_bytearray  # raises before a color the mug can't take is stored
         self.color = color
+        return self.writes.submit(Request.LightColor, data)
+
+    async def set_color(self, color: Color):
+        await self.queue_color(color)
 
     @ble_error_catch
     async def fetch_temperature_scale(self):
-        value = await self.client.read_gatt_char(Request.TemperatureScale.as_uuid)
-        self.temperature_scale = TemperatureScale(value[0])
+        await self._apply(Request.TemperatureScale, await self._read(Request.TemperatureScale))
 
-    @ble_error_catch
-    async def set_temperature_scale(self, scale: TemperatureScale):
-        await self.client.write_gatt_char(Request.TemperatureScale.as_uuid, scale.as_bytearray)
+    def queue_temperature_scale(self, scale: TemperatureScale) -> asyncio.Future:
         self.temperature_scale = scale
+        return self.writes.submit(Request.TemperatureScale, scale.as_bytearray)
+
+    async def set_temperature_scale(self, scale: TemperatureScale):
+        await self.queue_temperature_scale(scale)
+
+    @property
+    def reads_avoided(self) -> int:
+        # compared with polling both characteristics every poll_interval
+        return max(0, 2 * self.poll_ticks - self.poll_reads - self.event_reads)
+
+    def next_poll_interval(self, now: float) -> float:
+        if self.event_driven:
+            return self.fallback_interval
+        if self.adaptive:
+            return self.predictor.poll_interval(self.poll_interval, self.max_poll_interval, now)
+        return self.poll_interval
 
     @ble_error_catch
     async def set_schedule(self):
+        last_poll = None
         while True:
             if not self.running:
                 break
-            await self.fetch_state()
-            await self.fetch_setting_temperature()
-            await asyncio.sleep(1)
-
-    async def initial_fetch_values(self, run_updater=False):
-        await self.fetch_state()
-        await self.fetch_color()
-        await self.fetch_temperature_scale()
-        await self.fetch_setting_temperature()
-        await self.fetch_temperature()
-        await self.fetch_battery_state()
+            now = time.monotonic()
+            # re-evaluated every tick, so a temperature notification can bring the next poll forward.
+            # half a tick of slack, sleep() may return marginally early
+            if last_poll is None or now - last_poll >= self.next_poll_interval(now) - self.poll_interval / 2:
+                await self.fetch_state()
+                await self.fetch_setting_temperature()
+                self.poll_reads += 2
+                last_poll = now
+            self.poll_ticks += 1
+            await asyncio.sleep(self.poll_interval)
 
-        async def updater():
-            while self.running and self.gui.alive:
-                self.gui.update_()
-                self.gui.update()
-                await asyncio.sleep(1 / 15)
-            await self.quit()
-
-        if run_updater:
-            await asyncio.gather(updater())
+    @ble_error_catch
+    async def fetch_snapshot(self):
+        # values are applied only once every read has returned, so observers never see a half-updated mug
+        snapshot = await self.scheduler.read_many(self.snapshot_characteristics, self._read)
+        for character in self.snapshot_characteristics:
+            if character in snapshot:
+                await self._apply(character, snapshot[character])
+
+    async def initial_fetch_values(self):
+        await self.fetch_snapshot()
+        if self.started_at is not None:
+            self.time_to_first_snapshot = time.monotonic() - self.started_at
 
     async def quit(self):
-        print('quitting...')
+        print('quitting...', file=sys.stderr)  # stdout is left to JSON output, see daemon.py and sharding.py
         self.running = False
+        self.closed = True
+        self.bus.close()
+        try:
+            await asyncio.wait_for(self.writes.flush(), 2)
+        except asyncio.TimeoutError:
+            warn('pending writes were dropped when quitting.')
+        if self.snapshots is not None:
+            self.snapshots.flush()
         await self.client.disconnect()
 
-    def notify_callback(self):
-        @ble_error_catch
-        async def callback(_: int, data: bytearray) -> None:
-            if not self.running:
-                return await self.client.stop_notify(Request.Notification.as_uuid)
+    def register_notification_handlers(self):
+        # the default dispatch table. other code can add handlers with self.bus.subscribe
+        self.bus.subscribe(self.on_battery_notification, NotificationValue.BatteryChargeChange,
+                           NotificationValue.OnCoaster, NotificationValue.OffCoaster)
+        self.bus.subscribe(self.on_temperature_notification, NotificationValue.TemperatureChange,
+                           NotificationValue.HeatingStateChange)
+        self.bus.subscribe(self.on_state_notification, *self.state_notifications)
+
+    async def on_battery_notification(self, _: NotificationValue):
+        await self.fetch_battery_state()
+
+    async def on_temperature_notification(self, _: NotificationValue):
+        await self.fetch_temperature()
+
+    async def on_state_notification(self, notification: NotificationValue):
+        if not self.event_driven:
+            return
+        await self.fetch_state()
+        self.event_reads += 1
+        if notification is NotificationValue.Poured:
+            await self.fetch_setting_temperature()
+            self.event_reads += 1
+
+    def handle_notification(self, data: bytearray):
+        # runs inside the Bluetooth callback, so nothing is awaited here
+        if not self.running:
+            self.bus.close()
+            asyncio.ensure_future(self.stop_notifications())
+            return
+        try:
             notification = NotificationValue(data[0])
+        except ValueError:
+            return warn('unknown notification {}'.format(notification_name(data[0])))
+        self.cache.invalidate_for(notification)
+        self.bus.publish(notification)
 
-            if (notification is NotificationValue.BatteryChargeChange or
-                    notification is NotificationValue.OnCoaster or
-                    notification is NotificationValue.OffCoaster):
-                await self.fetch_battery_state()
+    @ble_error_catch
+    async def stop_notifications(self):
+        await self.client.stop_notify(Request.Notification.as_uuid)
 
-            elif (notification is NotificationValue.TemperatureChange or
-                  notification is NotificationValue.HeatingStateChange):
-                await self.fetch_temperature()
+    def notify_callback(self):
+        def callback(_: int, data: bytearray) -> None:
+            self.handle_notification(data)
 
         return callback
+
+
+def notification_name(code: int) -> str:
+    try:
+        return NotificationValue(code).name
+    except ValueError:
+        return '0x{:02x}'.format(code)
@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import time
+from typing import Tuple, Union
+
+from utils import Color, TemperatureScale
+from animation import Animator, Effect, blink, fade, pulse
+from controller import Controller
+from discovery import KnownDevices, bring_up
+from fleet import Fleet
+from snapshot import SnapshotStore
+from metrics import registry as metrics_registry
+
+MIN_SETTING_TEMPERATURE = 50.0
+MAX_SETTING_TEMPERATURE = 62.5
+
+# effects come from the network, an hour long cycle or 20 writes a second is plenty
+MAX_EFFECT_SECONDS = 3600.0
+MAX_EFFECT_REPEAT = 10000
+MAX_BUDGET = 20.0
+
+
+class RequestError(Exception):
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_color(value) -> Color:
+    if isinstance(value, str):
+        value = value.lstrip('#')
+        if len(value) not in (6, 8):
+            raise RequestError('400 Bad Request', 'color must be #rrggbb or #rrggbbaa')
+        return Color(*bytes.fromhex(value))
+    if isinstance(value, list) and len(value) in (3, 4):
+        if not all(isinstance(part, int) and not isinstance(part, bool) and 0 <= part <= 255 for part in value):
+            raise RequestError('400 Bad Request', 'color components must be integers within 0-255')
+        return Color(*value)
+    raise RequestError('400 Bad Request', 'color must be #rrggbb, #rrggbbaa or [r, g, b(, a)]')
+
+
+def parse_command(command: dict) -> dict:
+    # every field is validated before anything is queued, so a bad field leaves the mug untouched
+    values = {}
+    if 'setting_temperature' in command:
+        value = command['setting_temperature']
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise RequestError('400 Bad Request', 'setting_temperature must be a number')
+        value = float(value)
+        if value != 0 and not MIN_SETTING_TEMPERATURE <= value <= MAX_SETTING_TEMPERATURE:
+            raise RequestError('400 Bad Request', 'setting_temperature must be 0 (off) or within {}-{}'.format(
+                MIN_SETTING_TEMPERATURE, MAX_SETTING_TEMPERATURE))
+        values['setting_temperature'] = value
+    if 'color' in command:
+        values['color'] = parse_color(command['color'])
+    if 'temperature_scale' in command:
+        value = command['temperature_scale']
+        if not isinstance(value, str) or value not in TemperatureScale.__members__:
+            raise RequestError('400 Bad Request', 'temperature_scale must be Celsius or Fahrenheit')
+        values['temperature_scale'] = TemperatureScale[value]
+    return values
+
+
+def queue_command(controller: Controller, command: dict) -> list:
+    # returns the futures of the queued writes
+    try:
+        values = parse_command(command)
+    except TypeError as e:
+        raise RequestError('400 Bad Request', str(e))
+    futures = []
+    if 'setting_temperature' in values:
+        futures.append(controller.queue_setting_temperature(values['setting_temperature']))
+    if 'color' in values:
+        futures.append(controller.queue_color(values['color']))
+    if 'temperature_scale' in values:
+        futures.append(controller.queue_temperature_scale(values['temperature_scale']))
+    return futures
+
+
+def parse_number(command: dict, name: str, default, maximum, integer=False):
+    # positive, at most maximum. integers for counts
+    value = command.get(name, default)
+    kinds = (int,) if integer else (int, float)
+    if not isinstance(value, kinds) or isinstance(value, bool) or not 0 < value <= maximum:
+        raise RequestError('400 Bad Request', '{} must be {} within 0-{}'.format(
+            name, 'an integer' if integer else 'a positive number', maximum))
+    return value if integer else float(value)
+
+
+def parse_effect(command: dict) -> Effect:
+    name = command.get('effect')
+    if 'color' not in command:
+        raise RequestError('400 Bad Request', 'an effect needs a color')
+    color = parse_color(command['color'])
+    if name == 'pulse':
+        period = parse_number(command, 'period', 2.0, MAX_EFFECT_SECONDS)
+        repeat = None if command.get('repeat') is None else parse_number(command, 'repeat', None, MAX_EFFECT_REPEAT,
+                                                                         integer=True)
+        return pulse(color, period, repeat)
+    if name == 'blink':
+        return blink(color, parse_number(command, 'times', 3, MAX_EFFECT_REPEAT, integer=True),
+                     parse_number(command, 'period', 0.5, MAX_EFFECT_SECONDS))
+    if name == 'fade':
+        start = parse_color(command['from']) if 'from' in command else Color(0, 0, 0, 0)
+        return fade(color, parse_number(command, 'seconds', 2.0, MAX_EFFECT_SECONDS), start)
+    raise RequestError('400 Bad Request', 'effect must be pulse, blink or fade')
+
+
+class Daemon:
+    def __init__(self, fleet: Fleet):
+        self.fleet = fleet
+        self.animator = Animator()
+        self.started = time.monotonic()
+
+    def controller(self, address: str) -> Controller:
+        try:
+            return self.fleet[address]
+        except KeyError:
+            raise RequestError('404 Not Found', 'unknown mug {!r}'.format(address))
+
+    async def apply(self, address: str, command: dict) -> dict:
+        controller = self.controller(address)
+        futures = queue_command(controller, command)
+        if 'color' in command:
+            self.animator.stop(address, restore=False)  # a color set by hand ends the effect
+        if command.get('wait') and futures:
+            written = await asyncio.gather(*futures)
+            return dict(controller.as_dict(), written=all(written))
+        return controller.as_dict()
+
+    async def batch(self, commands: list) -> list:
+        # commands for different mugs are written concurrently, each mug keeps its own write order
+        async def run(command):
+            if not isinstance(command, dict) or 'address' not in command:
+                return {'error': 'every command needs an address'}
+            try:
+                return await self.apply(command['address'], command)
+            except (RequestError, ValueError, TypeError) as e:
+                return {'address': command.get('address'), 'error': str(e)}
+
+        return list(await asyncio.gather(*(run(command) for command in commands)))
+
+    def animate(self, command: dict) -> dict:
+        # one effect on the given mugs, or on all of them, started on the same frame
+        effect = parse_effect(command)
+        budget = None if command.get('budget') is None else parse_number(command, 'budget', None, MAX_BUDGET)
+        addresses = command.get('addresses')
+        if addresses is not None and not (isinstance(addresses, list) and all(isinstance(address, str)
+                                                                               for address in addresses)):
+            raise RequestError('400 Bad Request', 'addresses must be a list of mug addresses')
+        controllers = [self.controller(address) for address in addresses] if addresses else list(self.fleet)
+        playbacks = self.animator.play_fleet(controllers, effect, budget)
+        return {'effect': effect.name, 'frames': len(effect.frames), 'mugs': [playback.address for playback in playbacks],
+                'started_at': playbacks[0].started_at if playbacks else None}
+
+    def status(self) -> dict:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            'mugs': len(self.fleet),
+            'uptime': time.monotonic() - self.started,
+            'cpu_seconds': usage.ru_utime + usage.ru_stime,
+            'max_rss_kb': usage.ru_maxrss,
+            'connections': self.fleet.connection_stats(),
+        }
+
+    async def route(self, method: str, path: str, body: bytes) -> Tuple[str, Union[dict, list, str]]:
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        payload = None
+        if body:
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                raise RequestError('400 Bad Request', 'body is not valid JSON')
+
+        if method == 'GET' and parts == ['mugs']:
+            return '200 OK', self.fleet.states()
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'mugs':
+            return '200 OK', self.controller(parts[1]).as_dict()
+        if method == 'POST' and len(parts) == 2 and parts[0] == 'mugs':
+            if not isinstance(payload, dict):
+                raise RequestError('400 Bad Request', 'expected a JSON object')
+            return '200 OK', await self.apply(parts[1], payload)
+        if method == 'POST' and parts == ['batch']:
+            if not isinstance(payload, list):
+                raise RequestError('400 Bad Request', 'expected a JSON list of commands')
+            return '200 OK', await self.batch(payload)
+        if method == 'POST' and parts == ['animations']:
+            if not isinstance(payload, dict):
+                raise RequestError('400 Bad Request', 'expected a JSON object')
+            return '200 OK', self.animate(payload)
+        if method == 'GET' and parts == ['animations']:
+            return '200 OK', self.animator.stats()
+        if method == 'DELETE' and parts == ['animations']:
+            self.animator.stop_all()
+            return '200 OK', self.animator.stats()
+        if method == 'GET' and parts == ['status']:
+            return '200 OK', self.status()
+        if method == 'GET' and parts == ['metrics']:
+            return '200 OK', metrics_registry.render()
+        raise RequestError('404 Not Found', 'no route for {} {}'.format(method, path))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            length = 0
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                if key.lower() == 'content-length':
+                    length = int(value)
+            body = await reader.readexactly(length) if length else b''
+            try:
+                if len(request) < 2:
+                    raise RequestError('400 Bad Request', 'malformed request line')
+                status, result = await self.route(request[0], request[1], body)
+            except RequestError as e:
+                status, result = e.status, {'error': str(e)}
+            except (ValueError, TypeError) as e:
+                status, result = '400 Bad Request', {'error': str(e)}
+
+            if isinstance(result, str):
+                content_type, data = 'text/plain; version=0.0.4', result.encode()
+            else:
+                content_type, data = 'application/json', json.dumps(result).encode()
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                status, content_type, len(data)).encode() + data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8765, unix: Union[str, None] = None):
+        if unix is not None:
+            if os.path.exists(unix):
+                os.remove(unix)
+            return await asyncio.start_unix_server(self.handle, unix)
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Run Ember mug controllers headless with a local HTTP API.')
+    parser.add_argument('--address', action='append', default=None,
+                        help='only connect to this mug (address or name), may be given more than once')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this unix socket instead of TCP')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to scan for mugs')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='GATT operations in flight across all mugs')
+    parser.add_argument('--history-dir', help='persist telemetry history of each mug in this directory')
+    parser.add_argument('--record-dir', help='record the GATT traffic of each mug in this directory, see replay.py')
+    parser.add_argument('--simulate', type=int, default=0, help='run this many simulated mugs instead of real ones')
+    args = parser.parse_args()
+
+    # simulated mugs start from scratch, real ones from the values of the last run
+    fleet = Fleet(args.max_in_flight, history_dir=args.history_dir,
+                  snapshots=None if args.simulate else SnapshotStore(), record_dir=args.record_dir)
+    if args.simulate:
+        from simulator import SimulatedMug
+        for i in range(args.simulate):
+            mug = SimulatedMug('SIM:{:05d}'.format(i))
+            await mug.connect()
+            fleet.add(mug)
+    else:
+        await bring_up(fleet, KnownDevices(), allow=args.address, timeout=args.timeout)
+    print('{} mug(s) connected.'.format(len(fleet)))
+
+    daemon = Daemon(fleet)
+    server = await daemon.serve(args.host, args.port, args.unix)
+    print('listening on {}'.format(args.unix or 'http://{}:{}'.format(args.host, args.port)))
+    try:
+        await fleet.start()
+    finally:
+        server.close()
+        daemon.animator.stop_all()
+        await daemon.animator.wait()
+        await fleet.quit()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Union
+from warnings import warn
+
+from bleak import BleakScanner
+from bleak.backends.device import BLEDevice
+from bleak.exc import BleakError
+
+from utils import EMBER_MANUFACTURER_CODE
+
+KNOWN_DEVICES_PATH = os.path.join(os.path.expanduser('~'), '.ember-mug-controller', 'known_devices.json')
+
+# MAC addresses, and the UUIDs CoreBluetooth uses instead of them on macOS
+ADDRESS_PATTERN = re.compile(r'^([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$|^[0-9A-Fa-f]{8}(-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}$')
+
+
+def looks_like_address(value: str) -> bool:
+    # anything else is a name, which only a scan can resolve
+    return isinstance(value, str) and ADDRESS_PATTERN.match(value) is not None
+
+
+class KnownDevices:
+    def __init__(self, path: str = KNOWN_DEVICES_PATH):
+        self.path = path
+        self.devices: Dict[str, dict] = {}
+        self.load()
+
+    def __contains__(self, address: str):
+        return address in self.devices
+
+    def __iter__(self):
+        # most recently seen first
+        return iter(sorted(self.devices, key=lambda a: self.devices[a].get('last_seen', 0), reverse=True))
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.devices = json.load(f)
+        except FileNotFoundError:
+            self.devices = {}
+        except (OSError, ValueError) as e:
+            warn(f"could not read known devices from {self.path!r}: {e!r}")
+            self.devices = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.devices, f, indent=2)
+        os.replace(temporary, self.path)
+
+    def remember(self, address: str, name: Union[str, None] = None):
+        self.devices[address] = {'name': name, 'last_seen': time.time()}
+        self.save()
+
+    def forget(self, address: str):
+        if self.devices.pop(address, None) is not None:
+            self.save()
+
+
+def is_ember(device: BLEDevice, advertisement_data=None) -> bool:
+    if advertisement_data is not None and advertisement_data.manufacturer_data:
+        return EMBER_MANUFACTURER_CODE in advertisement_data.manufacturer_data
+    return EMBER_MANUFACTURER_CODE in device.metadata.get('manufacturer_data', {})
+
+
+def allowed(device: BLEDevice, allow: Union[Iterable[str], None]) -> bool:
+    return allow is None or device.address in allow or device.name in allow
+
+
+async def scan(timeout: float = 10.0, allow: Union[Iterable[str], None] = None, limit: Union[int, None] = None,
+               **scanner_kwargs) -> AsyncIterator[BLEDevice]:
+    # yields each mug as soon as its advertisement is seen instead of waiting for the whole scan window
+    allow = None if allow is None else set(allow)
+    found = asyncio.Queue()
+    seen = set()
+
+    def detected(device: BLEDevice, advertisement_data):
+        if device.address in seen or not is_ember(device, advertisement_data) or not allowed(device, allow):
+            return
+        seen.add(device.address)
+        found.put_nowait(device)
+
+    scanner = BleakScanner(**scanner_kwargs)
+    scanner.register_detection_callback(detected)
+    await scanner.start()
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    yielded = 0
+    try:
+        while limit is None or yielded < limit:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                device = await asyncio.wait_for(found.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            yielded += 1
+            yield device
+    finally:
+        await scanner.stop()
+
+
+async def bring_up(fleet: 'Fleet', known: Union[KnownDevices, None] = None,
+                   allow: Union[Iterable[str], None] = None, timeout: float = 10.0) -> List[str]:
+    # known mugs are connected directly while the scan runs, so an absent one costs nothing but its own attempt.
+    # the rest are connected as they are discovered
+    allow = None if allow is None else set(allow)
+    known = known if known is not None else KnownDevices()
+    remaining = set() if allow is None else set(allow)  # allowed addresses and names not connected yet
+    satisfied = asyncio.Event()
+
+    async def connect(target) -> bool:
+        try:
+            controller = await fleet.connect_device(target)
+        except (RuntimeError, BleakError, asyncio.TimeoutError, OSError) as e:
+            warn(f"could not connect to {target!r}: {e!r}")
+            return False
+        name = getattr(target, 'name', None) or known.devices.get(controller.address, {}).get('name')
+        known.remember(controller.address, name)
+        remaining.difference_update((controller.address, name))
+        if allow is not None and not remaining:
+            satisfied.set()
+        return True
+
+    direct: Dict[str, asyncio.Future] = {}
+    for address in list(known) + sorted(allow or ()):
+        if address in direct or not looks_like_address(address):
+            continue
+        if allow is None or address in allow or known.devices.get(address, {}).get('name') in allow:
+            direct[address] = asyncio.ensure_future(connect(address))
+
+    scanned: List[asyncio.Future] = []
+
+    async def discover():
+        async for device in scan(timeout, allow=allow):
+            if device.address in fleet.controllers:
+                continue
+            attempt = direct.get(device.address)
+            if attempt is not None and not attempt.done():
+                attempt.cancel()  # it is in range after all, connecting to the found device skips the lookup
+            scanned.append(asyncio.ensure_future(connect(device)))
+
+    scanning = asyncio.ensure_future(discover())
+    waiting = asyncio.ensure_future(satisfied.wait())
+    await asyncio.wait({scanning, waiting}, return_when=asyncio.FIRST_COMPLETED)
+    waiting.cancel()
+    scanning.cancel()  # every allowed mug is connected, the rest of the scan window is not needed
+    for attempt in direct.values():
+        attempt.cancel()  # a mug in range would have shown up in the scan by now
+    results = await asyncio.gather(scanning, *direct.values(), *scanned, return_exceptions=True)
+    if isinstance(results[0], Exception) and not isinstance(results[0], asyncio.CancelledError):
+        warn(f"scanning for mugs failed: {results[0]!r}")
+
+    return list(fleet.controllers)
@@ -0,0 +1,161 @@
+import asyncio
+import itertools
+import os
+import time
+from typing import Dict, Iterable, List, Union
+from warnings import warn
+
+from bleak import BleakClient
+from bleak.backends.device import BLEDevice
+from bleak.exc import BleakError
+
+from controller import Controller
+from supervisor import ConnectionSupervisor
+from telemetry import TelemetryRecorder
+from snapshot import SnapshotStore
+from replay import RecordingClient
+
+
+class Fleet:
+    restart_delay = 5  # seconds to wait before restarting a crashed controller
+
+    def __init__(self, max_in_flight: int = 8, notify_when_complete=False, max_restarts: int = 3,
+                 event_driven=True, history_dir: Union[str, None] = None, history_capacity: int = 4096,
+                 reconnect=True, snapshots: Union[SnapshotStore, None] = None, record_dir: Union[str, None] = None,
+                 adapter: Union[str, None] = None):
+        # one semaphore for the whole fleet, so dozens of mugs can't saturate the adapter
+        self.gatt_limit = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.notify_when_complete = notify_when_complete
+        self.max_restarts = max_restarts
+        self.event_driven = event_driven
+        self.history_dir = history_dir
+        self.history_capacity = history_capacity
+        self.reconnect = reconnect
+        # one store for every mug, so all of them are written in one file
+        self.snapshots = snapshots
+        # GATT traffic of every mug is recorded here, see replay.py
+        self.record_dir = record_dir
+        # bluetooth adapter (e.g. hci1) new connections are made on, the backend's default when None
+        self.adapter = adapter
+
+        self.controllers: Dict[str, Controller] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.restarts: Dict[str, int] = {}
+        self.errors: Dict[str, Union[BaseException, None]] = {}
+        self.telemetry: Dict[str, TelemetryRecorder] = {}
+        self.supervisors: Dict[str, ConnectionSupervisor] = {}
+        self.recordings: Dict[str, RecordingClient] = {}
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def __iter__(self):
+        return iter(self.controllers.values())
+
+    def __getitem__(self, address: str) -> Controller:
+        return self.controllers[address]
+
+    def record(self, client: BleakClient) -> RecordingClient:
+        stem = '{}-{}'.format(client.address.replace(':', ''), time.strftime('%Y%m%d-%H%M%S'))
+        for attempt in itertools.count():
+            name = stem + ('-{}'.format(attempt) if attempt else '') + '.trace'
+            try:
+                return RecordingClient(client, os.path.join(self.record_dir, name))
+            except FileExistsError:  # the same mug was added again within the second
+                continue
+
+    def add(self, client: BleakClient) -> Controller:
+        if self.record_dir is not None:
+            os.makedirs(self.record_dir, exist_ok=True)
+            # one trace per run, a restart must not overwrite the previous recording
+            client = self.recordings[client.address] = self.record(client)
+        controller = Controller(client, self.notify_when_complete, gatt_limit=self.gatt_limit,
+                                event_driven=self.event_driven, snapshots=self.snapshots)
+        self.controllers[client.address] = controller
+        self.restarts[client.address] = 0
+        self.errors[client.address] = None
+
+        path = None
+        if self.history_dir is not None:
+            os.makedirs(self.history_dir, exist_ok=True)
+            path = os.path.join(self.history_dir, client.address.replace(':', '') + '.bin')
+        recorder = TelemetryRecorder(self.history_capacity, path)
+        recorder.attach(controller)
+        self.telemetry[client.address] = recorder
+        if self.reconnect:
+            self.supervisors[client.address] = ConnectionSupervisor(controller)
+        return controller
+
+    async def connect_device(self, address_or_device: Union[str, BLEDevice], timeout: float = 10.0) -> Controller:
+        # a BLEDevice from a running scan skips BleakClient's own lookup
+        if self.adapter is not None:
+            client = BleakClient(address_or_device, timeout=timeout, adapter=self.adapter)
+        else:
+            client = BleakClient(address_or_device, timeout=timeout)
+        await client.connect()
+        return self.add(client)
+
+    async def connect(self, addresses: Iterable[str], timeout: float = 10.0) -> List[str]:
+        addresses = list(addresses)
+        results = await asyncio.gather(*(self.connect_device(address, timeout) for address in addresses),
+                                       return_exceptions=True)
+        failed = []
+        for address, result in zip(addresses, results):
+            if isinstance(result, BaseException):
+                warn(f"could not connect to {address!r}: {result!r}")
+                failed.append(address)
+        return failed
+
+    def spawn(self, address: str) -> asyncio.Task:
+        task = self.tasks.get(address)
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._supervise(self.controllers[address]))
+            self.tasks[address] = task
+        return task
+
+    async def start(self):
+        await asyncio.gather(*(self.spawn(address) for address in list(self.controllers)), return_exceptions=True)
+
+    async def _supervise(self, controller: Controller):
+        address = controller.address
+        if address in self.supervisors:
+            # reconnects by itself, restarting the controller on every new connection
+            return await self.supervisors[address].run()
+        while True:
+            try:
+                await controller.start()
+                return
+            except asyncio.CancelledError:
+                raise
+            except (RuntimeError, BleakError, OSError) as e:
+                self.errors[address] = e
+                if self.restarts[address] >= self.max_restarts:
+                    warn(f"giving up on {address!r} after {self.restarts[address]} restarts: {e!r}")
+                    controller.running = False
+                    return
+                self.restarts[address] += 1
+                warn(f"controller for {address!r} crashed ({e!r}), restarting in {self.restart_delay}s")
+                await asyncio.sleep(self.restart_delay)
+
+    def states(self) -> Dict[str, dict]:
+        return {address: controller.as_dict() for address, controller in self.controllers.items()}
+
+    def connection_stats(self) -> Dict[str, dict]:
+        return {address: supervisor.stats() for address, supervisor in self.supervisors.items()}
+
+    def running(self) -> List[str]:
+        return [address for address, task in self.tasks.items() if not task.done()]
+
+    async def quit(self):
+        for supervisor in self.supervisors.values():
+            supervisor.stopped = True
+        await asyncio.gather(*(controller.quit() for controller in self.controllers.values()),
+                             return_exceptions=True)
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for recorder in self.telemetry.values():
+            recorder.flush()
+        for recording in self.recordings.values():
+            recording.close()
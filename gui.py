@@ -1,9 +1,10 @@
-import asyncio
+import time
 import tkinter as tk
+from collections import deque
+from typing import Callable, Union
 from utils import Color, State, BatteryState, TemperatureScale, TemperatureConversion
-from PIL import ImageTk
-
-from tkcolorpicker import askcolor
+from assets import AssetRegistry, registry
+from bridge import LoopBridge
 
 ORANGE = '#ffba2e'
 DORANGE = '#b28220'
@@ -11,8 +12,15 @@ GRAY = '#555555'
 
 
 class Application(tk.Frame):
-    def __init__(self, controller: 'Controller', master=None):
+    frame_interval = 1 / 15  # seconds between two checks for changed values
+
+    def __init__(self, controller: 'Controller', master=None, assets: AssetRegistry = registry,
+                 bridge: Union[LoopBridge, None] = None):
+        started = time.perf_counter()
         super().__init__(master)
+        self.assets = assets
+        # with a bridge the controller runs on another thread, and is only ever touched through it
+        self.bridge = bridge
 
         self.master = master
         self.master.overrideredirect(True)  # turns off title bar, geometry
@@ -35,6 +43,22 @@ class Application(tk.Frame):
 
         self.temperature_scale = TemperatureScale.Celsius
 
+        # names of controller values changed since the last repaint
+        self.dirty = set(controller.observed)
+        self.frame_times = deque(maxlen=300)
+        if bridge is not None:
+            controller.subscribe(lambda name, value: bridge.post(self.mark_dirty, name, value))
+        else:
+            controller.subscribe(self.mark_dirty)
+        self.next_frame = time.perf_counter() + self.frame_interval
+        self.after(int(self.frame_interval * 1000), self.pump)
+
+        self.startup_time = time.perf_counter() - started
+
+    def image(self, path: str):
+        # decoded on first use and shared with every other window
+        return self.assets.photo(path, self.master)
+
     def close(self):
         print('called')
         self.alive = False
@@ -46,10 +70,10 @@ class Application(tk.Frame):
 
         def temperature_scale():
             if self.controller.temperature_scale == TemperatureScale.Celsius:
-                asyncio.gather(self.controller.set_temperature_scale(TemperatureScale.Fahrenheit))
+                self.command(self.controller.queue_temperature_scale, TemperatureScale.Fahrenheit)
                 self.temperature_scale_button.config(text=" °F ")
             else:
-                asyncio.gather(self.controller.set_temperature_scale(TemperatureScale.Celsius))
+                self.command(self.controller.queue_temperature_scale, TemperatureScale.Celsius)
                 self.temperature_scale_button.config(text=" °C ")
 
         def topmost():
@@ -159,28 +183,28 @@ class Application(tk.Frame):
         self.setting_temperature_label.place(x=365, y=155, anchor="center")
         self.state_label.place(x=360, y=195, anchor="center")
 
-        self.heat_img = ImageTk.PhotoImage(file='static/icon/heat.png')
+        self.heat_img = self.image('icon/heat.png')
         self.heat_button = tk.Button(self.canvas, width=60,
                                      height=65, command=self.change_setting_temperature(2),
                                      borderwidth=0, relief='sunken')
         self.heat_button.config(image=self.heat_img)
         self.heat_button.place(x=420, y=230)
 
-        self.weak_heat_img = ImageTk.PhotoImage(file='static/icon/weak_heat.png')
+        self.weak_heat_img = self.image('icon/weak_heat.png')
         self.weak_heat_button = tk.Button(self.canvas, width=43,
                                           height=43, command=self.change_setting_temperature(0.5),
                                           borderwidth=0, relief='sunken')
         self.weak_heat_button.config(image=self.weak_heat_img)
         self.weak_heat_button.place(x=377, y=243)
 
-        self.cool_img = ImageTk.PhotoImage(file='static/icon/cool.png')
+        self.cool_img = self.image('icon/cool.png')
         self.cool_button = tk.Button(self.canvas, width=60,
                                      height=70, command=self.change_setting_temperature(-2),
                                      borderwidth=0, relief='sunken')
         self.cool_button.config(image=self.cool_img)
         self.cool_button.place(x=245, y=230)
 
-        self.weak_cool_img = ImageTk.PhotoImage(file='static/icon/weak_cool.png')
+        self.weak_cool_img = self.image('icon/weak_cool.png')
         self.weak_cool_button = tk.Button(self.canvas, width=43,
                                           height=43, command=self.change_setting_temperature(-0.5),
                                           borderwidth=0, relief='sunken')
@@ -191,70 +215,111 @@ class Application(tk.Frame):
                                       bg='#ff0000', command=self.pick_color, image=self.pixelVirtual)
         self.color_button.place(x=96, y=218)
 
-        self.background = ImageTk.PhotoImage(file='static/background.png')
+        self.background = self.image('background.png')
         self.background_canvas = self.canvas.create_image(250, 162, image=self.background)
 
-        self.normal = ImageTk.PhotoImage(file='static/icon/normal.png')
-        self.charging = ImageTk.PhotoImage(file='static/icon/charging.png')
-        self.low = ImageTk.PhotoImage(file='static/icon/low.png')
-        self.battery_canvas = self.canvas.create_image(115, 265, image=self.normal)
+        self.battery_canvas = self.canvas.create_image(115, 265, image=self.image('icon/normal.png'))
 
-        self.empty = ImageTk.PhotoImage(file='static/mug/empty.png')
-        self.heating = ImageTk.PhotoImage(file='static/mug/heating.png')
-        self.complete = ImageTk.PhotoImage(file='static/mug/complete.png')
-        self.mug_canvas = self.canvas.create_image(125, 135, image=self.empty)
+        self.mug_canvas = self.canvas.create_image(125, 135, image=self.image('mug/empty.png'))
 
-    def update_(self):
-        if self.controller.battery is not None:
-            self.battery.set('{}%'.format(self.controller.battery.battery_charge))
-            if self.prev_battery.is_charging != self.controller.battery.is_charging:
-                if self.controller.battery.is_charging:
-                    self.canvas.itemconfig(self.battery_canvas, image=self.charging)
-                elif self.controller.battery.battery_charge > 20:
-                    self.canvas.itemconfig(self.battery_canvas, image=self.normal)
-                else:
-                    self.canvas.itemconfig(self.battery_canvas, image=self.low)
-            elif not self.controller.battery.is_charging:
-                if self.prev_battery.battery_charge <= 20 and self.controller.battery.battery_charge > 20:
-                    self.canvas.itemconfig(self.battery_canvas, image=self.normal)
-                elif self.prev_battery.battery_charge > 20 and self.controller.battery.battery_charge <= 20:
-                    self.canvas.itemconfig(self.battery_canvas, image=self.low)
-            self.prev_battery = self.controller.battery
-        if self.controller.temperature is not None:
-            if self.temperature_scale is TemperatureScale.Celsius:
-                self.temperature.set('{}°'.format(self.controller.temperature))
-            else:
-                self.temperature.set('{}°'.format(int(TemperatureConversion.c2f(self.controller.temperature))))
-        if self.controller.setting_temperature is not None:
-            if self.temperature_scale is TemperatureScale.Celsius:
-                self.setting_temperature.set('{}°'.format(self.controller.setting_temperature))
-            else:
-                self.setting_temperature.set('{}°'.format(int(TemperatureConversion.c2f(self.controller.setting_temperature))))
-        if self.controller.temperature_scale != self.temperature_scale:
-            if self.controller.temperature_scale == TemperatureScale.Celsius:
-                self.temperature_scale_button.config(text=" °C ")
-            else:
-                self.temperature_scale_button.config(text=" °F ")
-            self.temperature_scale = self.controller.temperature_scale
-        if self.controller.color is not None:
-            self.color_button.configure(bg=self.controller.color.as_rgb)
-        if self.controller.state is not None:
-            self.state.set(self.controller.state.name)
+    def mark_dirty(self, name: str, value):
+        self.dirty.add(name)
 
-            if self.controller.state in (State.Empty, State.FinishDrinking) and \
-                    self.prev_state in (State.Poured, State.Cooling, State.Heating, State.Keeping):
-                self.canvas.itemconfig(self.mug_canvas, image=self.empty)
-                self.prev_state = self.controller.state
+    def command(self, func: Callable, *args):
+        # controller methods are called on the controller's loop
+        if self.bridge is not None:
+            self.bridge.call(func, *args)
+        else:
+            func(*args)
+
+    def pump(self):
+        # scheduled on tk's own mainloop, so a slow GATT operation can't delay a repaint and vice versa
+        if not self.alive:
+            return
+        if self.bridge is not None:
+            self.bridge.ui_lag.append(max(0.0, time.perf_counter() - self.next_frame))
+            self.bridge.drain()
+        if self.dirty:
+            self.update_()
+        self.next_frame = time.perf_counter() + self.frame_interval
+        self.after(int(self.frame_interval * 1000), self.pump)
+
+    def frame_stats(self) -> dict:
+        # time spent in update_, in milliseconds, over the last frames that actually repainted
+        if not self.frame_times:
+            return {'frames': 0, 'mean_ms': 0.0, 'max_ms': 0.0}
+        return {'frames': len(self.frame_times),
+                'mean_ms': sum(self.frame_times) / len(self.frame_times) * 1000,
+                'max_ms': max(self.frame_times) * 1000}
 
-            elif self.prev_state in (State.Empty, State.FinishDrinking, State.Cooling, State.Keeping) and \
-                    self.controller.state in (State.Poured, State.Heating, State.Off):
-                self.canvas.itemconfig(self.mug_canvas, image=self.heating)
-                self.prev_state = self.controller.state
+    def update_(self):
+        started = time.perf_counter()
+        dirty, self.dirty = self.dirty, set()
 
-            elif self.prev_state in (State.Empty, State.FinishDrinking, State.Off, State.Heating) and \
-                    self.controller.state in (State.Cooling, State.Keeping):
-                self.canvas.itemconfig(self.mug_canvas, image=self.complete)
-                self.prev_state = self.controller.state
+        if 'temperature_scale' in dirty:
+            if self.controller.temperature_scale != self.temperature_scale:
+                if self.controller.temperature_scale == TemperatureScale.Celsius:
+                    self.temperature_scale_button.config(text=" °C ")
+                else:
+                    self.temperature_scale_button.config(text=" °F ")
+                self.temperature_scale = self.controller.temperature_scale
+            dirty.update(('temperature', 'setting_temperature'))
+        if 'battery' in dirty and self.controller.battery is not None:
+            self.update_battery()
+        if 'temperature' in dirty and self.controller.temperature is not None:
+            self.temperature.set(self.format_temperature(self.controller.temperature))
+        if 'setting_temperature' in dirty and self.controller.setting_temperature is not None:
+            self.setting_temperature.set(self.format_temperature(self.controller.setting_temperature))
+        if 'color' in dirty and self.controller.color is not None:
+            self.color_button.configure(bg=self.controller.color.as_rgb)
+        if 'state' in dirty and self.controller.state is not None:
+            self.update_state()
+        if dirty & {'stale', 'setting_temperature', 'state'}:
+            # values restored from the last run are dimmed until the mug confirms them
+            stale = self.controller.stale
+            self.setting_temperature_label.config(fg=DORANGE if 'setting_temperature' in stale else 'white')
+            self.state_label.config(fg=DORANGE if 'state' in stale else 'white')
+
+        self.frame_times.append(time.perf_counter() - started)
+
+    def format_temperature(self, value: float) -> str:
+        if self.temperature_scale is TemperatureScale.Celsius:
+            return '{}°'.format(value)
+        return '{}°'.format(int(TemperatureConversion.c2f(value)))
+
+    def update_battery(self):
+        self.battery.set('{}%'.format(self.controller.battery.battery_charge))
+        if self.prev_battery.is_charging != self.controller.battery.is_charging:
+            if self.controller.battery.is_charging:
+                self.canvas.itemconfig(self.battery_canvas, image=self.image('icon/charging.png'))
+            elif self.controller.battery.battery_charge > 20:
+                self.canvas.itemconfig(self.battery_canvas, image=self.image('icon/normal.png'))
+            else:
+                self.canvas.itemconfig(self.battery_canvas, image=self.image('icon/low.png'))
+        elif not self.controller.battery.is_charging:
+            if self.prev_battery.battery_charge <= 20 and self.controller.battery.battery_charge > 20:
+                self.canvas.itemconfig(self.battery_canvas, image=self.image('icon/normal.png'))
+            elif self.prev_battery.battery_charge > 20 and self.controller.battery.battery_charge <= 20:
+                self.canvas.itemconfig(self.battery_canvas, image=self.image('icon/low.png'))
+        self.prev_battery = self.controller.battery
+
+    def update_state(self):
+        self.state.set(self.controller.state.name)
+
+        if self.controller.state in (State.Empty, State.FinishDrinking) and \
+                self.prev_state in (State.Poured, State.Cooling, State.Heating, State.Keeping):
+            self.canvas.itemconfig(self.mug_canvas, image=self.image('mug/empty.png'))
+            self.prev_state = self.controller.state
+
+        elif self.prev_state in (State.Empty, State.FinishDrinking, State.Cooling, State.Keeping) and \
+                self.controller.state in (State.Poured, State.Heating, State.Off):
+            self.canvas.itemconfig(self.mug_canvas, image=self.image('mug/heating.png'))
+            self.prev_state = self.controller.state
+
+        elif self.prev_state in (State.Empty, State.FinishDrinking, State.Off, State.Heating) and \
+                self.controller.state in (State.Cooling, State.Keeping):
+            self.canvas.itemconfig(self.mug_canvas, image=self.image('mug/complete.png'))
+            self.prev_state = self.controller.state
 
     def change_setting_temperature(self, offset: float):
         def wrapper():
@@ -263,22 +328,24 @@ class Application(tk.Frame):
                 if set_temp == 0:
                     return
                 if set_temp + offset < 50:
-                    asyncio.gather(self.controller.set_setting_temperature(0))
+                    self.command(self.controller.queue_setting_temperature, 0)
                 else:
-                    asyncio.gather(self.controller.set_setting_temperature(set_temp + offset))
+                    self.command(self.controller.queue_setting_temperature, set_temp + offset)
             else:
                 if set_temp == 0:
                     set_temp += 49.5
 
                 if set_temp + offset > 62.5:
-                    asyncio.gather(self.controller.set_setting_temperature(62.5))
+                    self.command(self.controller.queue_setting_temperature, 62.5)
                 else:
-                    asyncio.gather(self.controller.set_setting_temperature(set_temp + offset))
+                    self.command(self.controller.queue_setting_temperature, set_temp + offset)
 
         return wrapper
 
     def pick_color(self):
+        from tkcolorpicker import askcolor  # only loaded once the dialog is opened
+
         color = askcolor((255, 255, 0), self, alpha=True)
         if not color:
             return
-        asyncio.gather(self.controller.set_color(Color(*color[0])))
+        self.command(self.controller.queue_color, Color(*color[0]))
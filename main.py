@@ -1,39 +1,132 @@
 from utils import *
-import tkinter as tk
+import argparse
 import asyncio
-from bleak import discover, BleakClient
+import threading
+import traceback
+from typing import Union
+from bleak import BleakClient
+from bleak.exc import BleakError
 from controller import Controller
-from gui import Application
-
-
-async def main():
-    devices = await discover()
-    for d in devices:
-        if EMBER_MANUFACTURER_CODE in d.metadata.get('manufacturer_data', {}):
-            user_input = input('Device {!r} found. Is this ember mug? Y/N [Y]: '.format(d.name)) or 'y'
-            if user_input.lower() == 'y':
-                ember = d
-                break
-    else:
-        print('Ember mug is not found. Exiting...')
-        return
-
-    async with BleakClient(ember.address) as client:
-        x = client.is_connected
-        print("Connected: {0}".format(x))
+from discovery import KnownDevices, looks_like_address, scan
+from bridge import LoopBridge
+from snapshot import SnapshotStore
+
+
+async def find_mug(args, known: KnownDevices) -> Union[BleakClient, None]:
+    # mugs we connected to before are tried directly while the scan runs, the first mug to connect wins
+    loop = asyncio.get_event_loop()
+    found = loop.create_future()
+
+    async def claim(client: BleakClient, name: Union[str, None]):
+        if found.done():  # another attempt was faster
+            await client.disconnect()
+            return
+        known.remember(client.address, name)
+        found.set_result(client)
+
+    async def direct(address: str):
+        client = BleakClient(address, timeout=args.timeout)
+        try:
+            await client.connect()
+        except (RuntimeError, BleakError, asyncio.TimeoutError, OSError):
+            return
+        await claim(client, known.devices.get(address, {}).get('name'))
+
+    attempts = [asyncio.ensure_future(direct(address)) for address in args.address or list(known)
+                if looks_like_address(address)]
+
+    async def discover():
+        devices = scan(args.timeout, allow=args.address or None)
+        try:
+            async for d in devices:
+                if found.done():
+                    return
+                if not args.yes:
+                    # the mugs we know are not worth a question, ask only once they failed
+                    await asyncio.gather(*attempts, return_exceptions=True)
+                    if found.done():
+                        return
+                    prompt = 'Device {!r} found. Is this ember mug? Y/N [Y]: '.format(d.name)
+                    user_input = await loop.run_in_executor(None, input, prompt) or 'y'
+                    if user_input.lower() != 'y':
+                        continue
+                client = BleakClient(d)
+                try:
+                    await client.connect()
+                except (RuntimeError, BleakError, asyncio.TimeoutError, OSError):
+                    continue
+                await claim(client, d.name)
+                return
+        finally:
+            await devices.aclose()
+
+    tasks = attempts + [asyncio.ensure_future(discover())]
+    everything = asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.wait({found, everything}, return_when=asyncio.FIRST_COMPLETED)
+    for task in tasks:
+        task.cancel()
+    await everything
+    return found.result() if found.done() else None
+
+
+def prepare_gui():
+    # tk, PIL and the GUI images are loaded on a worker thread while the scan is running
+    import gui
+    from assets import registry
+    registry.prewarm()
+
+
+async def connect(args) -> Union[Controller, None]:
+    client = await find_mug(args, KnownDevices())
+    if client is None:
+        return None
+    print("Connected: {0}".format(client.is_connected))
+    # created on the loop thread, asyncio primitives must belong to that loop
+    return Controller(client, True, snapshots=SnapshotStore())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ember Mug Controller')
+    parser.add_argument('--address', action='append', default=[],
+                        help='only connect to this mug (address or name), may be given more than once')
+    parser.add_argument('--yes', action='store_true', help="don't ask before connecting to a discovered mug")
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to scan for mugs')
+    args = parser.parse_args()
+
+    threading.Thread(target=prepare_gui, name='prepare-gui', daemon=True).start()
+
+    # asyncio runs on its own thread, tk keeps the main thread
+    bridge = LoopBridge().start()
+    try:
+        cont = bridge.run(connect(args))
+        if cont is None:
+            print('Ember mug is not found. Exiting...')
+            return
         try:
-            # await client.pair()
-            cont = Controller(client, True)
+            import tkinter as tk
+            from gui import Application
+
             root = tk.Tk()
-            root.protocol("WM_DELETE_WINDOW", lambda: asyncio.gather(cont.quit()))
             root.title('Ember Mug Controller')
-            gui = Application(cont, master=root)
-            await cont.start_with_gui(gui)
+            gui = Application(cont, master=root, bridge=bridge)
+            root.protocol("WM_DELETE_WINDOW", gui.close)
+
+            def stopped(future):
+                # start() ends only when the mug fails, e.g. on the first TemperatureScale read or start_notify
+                error = None if future.cancelled() else future.exception()
+                if error is not None:
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    bridge.post(gui.close)
+
+            bridge.submit(cont.start()).add_done_callback(stopped)
+            root.mainloop()
         except Exception as e:
-            import traceback
             traceback.print_exc()
-            await client.disconnect()
+        finally:
+            bridge.run(cont.quit())
+    finally:
+        bridge.stop()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -0,0 +1,125 @@
+import asyncio
+import os
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+# seconds. BLE round-trips are usually tens of milliseconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+HELP = {
+    'ember_gatt_seconds': ('histogram', 'Duration of GATT operations.'),
+    'ember_gatt_errors_total': ('counter', 'GATT operations that raised an error.'),
+    'ember_swallowed_errors_total': ('counter', 'Bluetooth errors swallowed by ble_error_catch.'),
+    'ember_notification_seconds': ('histogram', 'Time spent handling a notification.'),
+    'ember_notification_queue_depth': ('gauge', 'Notifications waiting to be dispatched.'),
+    'ember_notifications_coalesced_total': ('counter', 'Notifications merged into one already pending.'),
+    'ember_notifications_dropped_total': ('counter', 'Notifications dropped because the queue was full.'),
+    'ember_animation_frames_total': ('counter', 'Animation frames written to the LED.'),
+    'ember_animation_frames_dropped_total': ('counter', 'Animation frames skipped to stay within the write budget.'),
+    'ember_animation_fps': ('gauge', 'Frames per second achieved by the running animation.'),
+}
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], int] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        # callers on the hot path keep the returned object instead of looking it up each time
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def inc(self, name: str, amount: int = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self) -> str:
+        # prometheus text exposition format
+        lines = []
+        described = set()
+
+        def describe(name: str):
+            if name not in described:
+                described.add(name)
+                kind, text = HELP.get(name, ('untyped', name))
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+        for (name, labels), value in sorted(self.counters.items()) + sorted(self.gauges.items()):
+            describe(name)
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+    async def write_periodically(self, path: str, interval: float = 15.0):
+        # for node_exporter's textfile collector
+        while True:
+            self.write(path)
+            await asyncio.sleep(interval)
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 9464):
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass
+                if request.split()[1:2] == [b'/metrics']:
+                    status, body = '200 OK', self.render().encode()
+                else:
+                    status, body = '404 Not Found', b'not found\n'
+                writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             'Content-Length: {}\r\n\r\n'.format(status, len(body)).encode() + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+registry = Metrics()
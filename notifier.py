@@ -0,0 +1,109 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Tuple, Union
+from warnings import warn
+
+APP_NAME = 'Ember Mug Controller'
+
+
+def desktop_notification(title: str, message: str):
+    from plyer import notification  # only needed once a drink is ready, and not at all headless
+
+    notification.notify(title=title, message=message, app_name=APP_NAME)
+
+
+class Notifier:
+    device_interval = 180  # seconds before the same mug notifies again
+    global_interval = 10  # seconds between two desktop notifications of any mug
+    window = 2.0  # seconds to wait for other mugs finishing at the same time
+
+    def __init__(self, send: Callable[[str, str], None] = desktop_notification):
+        # send(title, message) blocks for hundreds of milliseconds on some platforms, so it only runs on the worker
+        self.send = send
+        self.queue: 'queue.Queue[Union[Tuple[float, str, str], None]]' = queue.Queue()
+        self.thread: Union[threading.Thread, None] = None
+        self.lock = threading.Lock()
+        self.last_by_device: Dict[str, float] = {}
+        self.last_sent_at: Union[float, None] = None
+
+        self.posted = 0
+        self.suppressed = 0
+        self.sent = 0
+        self.aggregated = 0
+        self.failed = 0
+
+    def drink_ready(self, device: str, temperature: str, interval: Union[float, None] = None) -> bool:
+        # called from the event loop and returns at once. False when the mug notified within its interval
+        now = time.monotonic()
+        interval = self.device_interval if interval is None else interval
+        with self.lock:
+            last = self.last_by_device.get(device)
+            if last is not None and now - last < interval:
+                self.suppressed += 1
+                return False
+            self.last_by_device[device] = now
+            self.posted += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+                self.thread.start()
+        self.queue.put((now, device, temperature))
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # collect the mugs that finish together, and everything that arrives while the global limit holds us back
+            deadline = item[0] + self.window
+            if self.last_sent_at is not None:
+                deadline = max(deadline, self.last_sent_at + self.global_interval)
+            stopping = False
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self.deliver(batch)
+            if stopping:
+                return
+
+    def deliver(self, batch: List[Tuple[float, str, str]]):
+        if len(batch) == 1:
+            title = 'Your Drink is Waiting For You!'
+            message = 'Your drink is waiting for you to drink!. It\'s nice and warm {}!'.format(batch[0][2])
+        else:
+            self.aggregated += len(batch) - 1
+            title = '{} Drinks are Waiting For You!'.format(len(batch))
+            message = ', '.join('{} ({})'.format(device, temperature) for _, device, temperature in batch)
+        self.last_sent_at = time.monotonic()
+        try:
+            self.send(title, message)
+        except Exception as e:  # a broken notification backend must not kill the worker
+            self.failed += 1
+            warn(f'desktop notification was failed: {e!r}')
+        else:
+            self.sent += 1
+
+    def close(self, timeout: Union[float, None] = None):
+        # pending notifications are still delivered
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {'posted': self.posted, 'suppressed': self.suppressed, 'sent': self.sent,
+                'aggregated': self.aggregated, 'failed': self.failed, 'pending': self.queue.qsize()}
+
+
+desktop = Notifier()
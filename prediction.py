@@ -0,0 +1,115 @@
+import math
+import time
+from typing import Union
+
+from utils import State
+
+
+class Predictor:
+    ambient = 22.0  # °C the drink cools towards
+    tolerance = 0.5  # mugs report Keeping within this many °C of the setting temperature
+    smoothing = 0.3  # weight of the newest sample in the moving averages
+    min_samples = 2  # samples of a phase needed before its rate is trusted
+    lead = 5.0  # seconds to poll ahead of a predicted transition
+
+    def __init__(self):
+        self.temperature: Union[float, None] = None
+        self.setting_temperature: Union[float, None] = None
+        self.state: Union[State, None] = None
+        self.updated_at: Union[float, None] = None
+
+        # °C per second while heating, and the newton's law of cooling constant per second
+        self.heating_rate: Union[float, None] = None
+        self.cooling_constant: Union[float, None] = None
+        self.heating_samples = 0
+        self.cooling_samples = 0
+
+    def attach(self, controller: 'Controller'):
+        controller.subscribe(self.on_change)
+
+    def on_change(self, name: str, value):
+        if name == 'temperature':
+            if value is not None:
+                self.observe(time.monotonic(), value)
+        elif name == 'setting_temperature':
+            self.setting_temperature = value
+        elif name == 'state':
+            self.state = value
+
+    def observe(self, timestamp: float, temperature: float):
+        # O(1) per sample, only the previous sample and the running averages are kept
+        previous, elapsed = self.temperature, None
+        if self.updated_at is not None:
+            elapsed = timestamp - self.updated_at
+        self.temperature = temperature
+        self.updated_at = timestamp
+        if previous is None or not elapsed or elapsed <= 0:
+            return
+
+        if self.state == State.Heating and temperature > previous:
+            self.heating_rate = self._average(self.heating_rate, (temperature - previous) / elapsed)
+            self.heating_samples += 1
+        elif self.state in (State.Cooling, State.Off) and self.ambient < temperature < previous:
+            constant = math.log((previous - self.ambient) / (temperature - self.ambient)) / elapsed
+            self.cooling_constant = self._average(self.cooling_constant, constant)
+            self.cooling_samples += 1
+
+    def _average(self, average: Union[float, None], value: float) -> float:
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def time_to_target(self, now: Union[float, None] = None) -> Union[float, None]:
+        # seconds until the mug is expected to report Keeping, None when there is nothing to predict
+        if self.temperature is None or not self.setting_temperature or self.updated_at is None:
+            return None
+        if self.state == State.Heating:
+            if self.heating_samples < self.min_samples or self.heating_rate <= 0:
+                return None
+            eta = (self.setting_temperature - self.tolerance - self.temperature) / self.heating_rate
+        elif self.state == State.Cooling:
+            target = self.setting_temperature + self.tolerance
+            if self.cooling_samples < self.min_samples or self.cooling_constant <= 0 or target <= self.ambient \
+                    or self.temperature <= self.ambient:  # e.g. a stale Cooling state, it never cools to target
+                return None
+            eta = math.log((self.temperature - self.ambient) / (target - self.ambient)) / self.cooling_constant
+        else:
+            return None
+        elapsed = (time.monotonic() if now is None else now) - self.updated_at
+        return max(0.0, eta - elapsed)
+
+    def cool_down(self, seconds: float) -> Union[float, None]:
+        # temperature expected after `seconds` without heating
+        if self.temperature is None or self.cooling_constant is None:
+            return None
+        return self.ambient + (self.temperature - self.ambient) * math.exp(-self.cooling_constant * seconds)
+
+    def poll_interval(self, minimum: float, maximum: float, now: Union[float, None] = None) -> float:
+        # poll rarely while heating or cooling is on track, and closely around the predicted Keeping transition
+        eta = self.time_to_target(now)
+        if eta is None:
+            return minimum
+        return min(maximum, max(minimum, eta - self.lead))
+
+    def stats(self) -> dict:
+        return {
+            'time_to_target': self.time_to_target(),
+            'heating_rate': self.heating_rate,
+            'cooling_constant': self.cooling_constant,
+            'heating_samples': self.heating_samples,
+            'cooling_samples': self.cooling_samples,
+        }
+
+
+if __name__ == '__main__':
+    predictor = Predictor()
+    predictor.setting_temperature = 55.0
+    predictor.state = State.Cooling
+    for second, temperature in enumerate((70.0, 68.0, 66.2, 64.5)):
+        predictor.observe(second, temperature)
+    print(predictor.time_to_target(3))
+    # a Cooling sample at or below ambient has nothing to predict
+    predictor.observe(4, 21.0)
+    assert predictor.time_to_target(4) is None
+    predictor.observe(5, predictor.ambient)
+    assert predictor.time_to_target(5) is None
@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import inspect
+import json
+import struct
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
+
+from bleak.exc import BleakError
+
+from utils import *
+from codec import BY_HANDLE, lookup
+
+# file: MAGIC, HEADER, address, then one RECORD and its payload per event
+MAGIC = b'EMBG\x01\x00\x00\x00'
+HEADER = struct.Struct('<dH')  # wall clock time of the start, length of the address
+RECORD = struct.Struct('<dBBH')  # seconds since the start, kind, characteristic, length of the payload
+
+READ, WRITE, NOTIFY, ERROR, CONNECT, DISCONNECT = range(1, 7)
+KINDS = {READ: 'read', WRITE: 'write', NOTIFY: 'notify', ERROR: 'error', CONNECT: 'connect', DISCONNECT: 'disconnect'}
+
+
+class Event(NamedTuple):
+    timestamp: float
+    kind: int
+    character: Union[Character, None]
+    payload: bytes
+
+
+class TraceWriter:
+    flush_every = 64  # events buffered before they are flushed to the file
+
+    def __init__(self, path: str, address: str = ''):
+        self.path = path
+        self.file = open(path, 'xb')  # never overwrites an earlier trace
+        encoded = address.encode()
+        self.file.write(MAGIC + HEADER.pack(time.time(), len(encoded)) + encoded)
+        self.started = time.monotonic()
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, kind: int, character: Union[Character, None] = None, payload: bytes = b''):
+        handle = 0 if character is None else character.characteristics
+        self.file.write(RECORD.pack(time.monotonic() - self.started, kind, handle, len(payload)) + payload)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_trace(path: str) -> Tuple[str, float, List[Event]]:
+    # returns (address, wall clock time of the start, events)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('{!r} is not a GATT trace'.format(path))
+    offset = len(MAGIC)
+    started, length = HEADER.unpack_from(data, offset)
+    offset += HEADER.size
+    address = data[offset:offset + length].decode()
+    offset += length
+
+    events = []
+    while offset + RECORD.size <= len(data):
+        timestamp, kind, handle, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # cut off while the recorder was writing
+        events.append(Event(timestamp, kind, BY_HANDLE.get(handle), data[offset:offset + length]))
+        offset += length
+    return address, started, events
+
+
+class RecordingClient:
+    # wraps the client a Controller uses and logs every GATT operation and notification
+    def __init__(self, client: 'BleakClient', path: str):
+        self.client = client
+        self.trace = TraceWriter(path, client.address)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def connect(self, **kwargs) -> bool:
+        connected = await self.client.connect(**kwargs)
+        self.trace.write(CONNECT)
+        return connected
+
+    async def disconnect(self) -> bool:
+        self.trace.write(DISCONNECT)
+        self.trace.flush()
+        return await self.client.disconnect()
+
+    def set_disconnected_callback(self, callback: Union[Callable, None], **kwargs):
+        def disconnected(client):
+            self.trace.write(DISCONNECT)
+            self.trace.flush()
+            if callback is not None:
+                callback(client)
+
+        self.client.set_disconnected_callback(disconnected, **kwargs)
+
+    async def read_gatt_char(self, uuid, **kwargs) -> bytearray:
+        character = lookup(uuid)
+        try:
+            data = await self.client.read_gatt_char(uuid, **kwargs)
+        except (RuntimeError, BleakError, asyncio.TimeoutError) as e:
+            self.trace.write(ERROR, character, str(e).encode()[:1024])
+            raise
+        self.trace.write(READ, character, bytes(data))
+        return data
+
+    async def write_gatt_char(self, uuid, data: bytearray, response: bool = False):
+        character = lookup(uuid)
+        try:
+            result = await self.client.write_gatt_char(uuid, data, response)
+        except (RuntimeError, BleakError, asyncio.TimeoutError) as e:
+            self.trace.write(ERROR, character, str(e).encode()[:1024])
+            raise
+        self.trace.write(WRITE, character, bytes(data))
+        return result
+
+    async def start_notify(self, uuid, callback: Callable, **kwargs):
+        character = lookup(uuid)
+        if inspect.iscoroutinefunction(callback):
+            async def recorded(sender, data: bytearray):
+                self.trace.write(NOTIFY, character, bytes(data))
+                await callback(sender, data)
+        else:
+            def recorded(sender, data: bytearray):
+                self.trace.write(NOTIFY, character, bytes(data))
+                callback(sender, data)
+        return await self.client.start_notify(uuid, recorded, **kwargs)
+
+    def close(self):
+        self.trace.close()
+
+
+class ReplayClient:
+    # plays a trace back in place of a BleakClient. notifications are emitted at their recorded time, divided by
+    # speed, or back to back when speed is None. reads answer what the mug answered next at that point of the trace
+    def __init__(self, path: str, speed: Union[float, None] = None):
+        self.address, self.started_at, self.events = read_trace(path)
+        self.speed = speed
+        self.duration = self.events[-1].timestamp if self.events else 0.0
+
+        # what the mug reported for each characteristic over time, failed reads are kept as None
+        self.timelines: Dict[Character, Tuple[List[float], List[Union[bytes, None]]]] = {}
+        for event in self.events:
+            if event.character is None or event.kind not in (READ, WRITE, ERROR):
+                continue
+            if event.kind == ERROR and not event.character.readable:
+                continue
+            times, payloads = self.timelines.setdefault(event.character, ([], []))
+            times.append(event.timestamp)
+            payloads.append(None if event.kind == ERROR else event.payload)
+        self.notifications = [event for event in self.events if event.kind == NOTIFY and event.character is not None]
+
+        self.now = 0.0
+        self.real_start: Union[float, None] = None
+        self.dispatching = False
+        self.connected = False
+        self.callbacks: Dict[Character, Callable] = {}
+        self.disconnected_callback: Union[Callable, None] = None
+
+        self.reads = 0
+        self.writes: List[Tuple[float, Character, bytes]] = []
+
+    @property
+    def is_connected(self) -> bool:
+        return self.connected
+
+    @property
+    def clock(self) -> float:
+        # seconds into the trace. it stands still while a notification is handled, so the reads it causes get the
+        # answers recorded right after it even when the replay runs behind
+        if self.speed is None or self.real_start is None or self.dispatching:
+            return self.now
+        return min(self.duration, (time.monotonic() - self.real_start) * self.speed)
+
+    async def connect(self, **kwargs) -> bool:
+        self.connected = True
+        return True
+
+    async def disconnect(self) -> bool:
+        self.connected = False
+        self.callbacks.clear()
+        return True
+
+    def set_disconnected_callback(self, callback: Union[Callable, None], **kwargs):
+        self.disconnected_callback = callback
+
+    async def read_gatt_char(self, uuid, **kwargs) -> bytearray:
+        character = lookup(uuid)
+        if not self.connected:
+            raise BleakError('Not connected')
+        times, payloads = self.timelines.get(character, ((), ()))
+        if not times:
+            raise BleakError('{} was never read in the trace'.format(character.name))
+        payload = payloads[min(bisect_left(times, self.clock), len(times) - 1)]
+        if payload is None:
+            raise BleakError('recorded failure on {}'.format(character.name))  # timeouts included
+        self.reads += 1
+        return bytearray(payload)
+
+    async def write_gatt_char(self, uuid, data: bytearray, response: bool = False):
+        if not self.connected:
+            raise BleakError('Not connected')
+        self.writes.append((self.clock, lookup(uuid), bytes(data)))
+
+    async def start_notify(self, uuid, callback: Callable, **kwargs):
+        self.callbacks[lookup(uuid)] = callback
+
+    async def stop_notify(self, uuid):
+        self.callbacks.pop(lookup(uuid), None)
+
+    async def play(self, idle: Union[Callable, None] = None):
+        # idle() is awaited after every notification, so the controller catches up before the trace moves on
+        self.real_start = time.monotonic()
+        for event in self.notifications:
+            if self.speed is not None:
+                delay = event.timestamp / self.speed - (time.monotonic() - self.real_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.now = event.timestamp
+            callback = self.callbacks.get(event.character)
+            if callback is None:
+                continue
+            self.dispatching = True
+            try:
+                result = callback(event.character.characteristics, bytearray(event.payload))
+                if inspect.isawaitable(result):
+                    await result
+                if idle is not None:
+                    await idle()
+            finally:
+                self.dispatching = False
+        self.now = self.duration
+
+
+class Decisions:
+    # stands in for the desktop notifier and judges notify() against the trace clock instead of the wall clock
+    def __init__(self, client: ReplayClient):
+        self.client = client
+        self.last: Dict[str, float] = {}
+        self.notified: List[Tuple[float, str, str]] = []
+        self.suppressed: List[Tuple[float, str, str]] = []
+
+    def drink_ready(self, device: str, temperature: str, interval: float = 180) -> bool:
+        now = self.client.clock
+        last = self.last.get(device)
+        if last is not None and now - last < interval:
+            self.suppressed.append((now, device, temperature))
+            return False
+        self.last[device] = now
+        self.notified.append((now, device, temperature))
+        return True
+
+
+async def replay(path: str, speed: Union[float, None] = None, **controller_kwargs) -> dict:
+    from controller import Controller
+
+    client = ReplayClient(path, speed)
+    decisions = Decisions(client)
+    controller_kwargs.setdefault('event_driven', True)
+    controller = Controller(client, notify_when_complete=True, metrics=None, notifier=decisions,
+                            cache_ttl={character: 0 for character in client.timelines}, **controller_kwargs)
+    if speed is None:
+        controller.writes.min_interval = 0
+
+    transitions = []
+    controller.subscribe(lambda name, value: name == 'state' and transitions.append((client.clock, value.name)))
+
+    async def idle():
+        while controller.bus.pending or (controller.bus.worker is not None and not controller.bus.worker.done()):
+            await asyncio.sleep(0)
+        await controller.writes.flush()
+
+    await client.connect()
+    task = asyncio.ensure_future(controller.start())
+    # the first snapshot is read at the start of the trace, before any notification is played
+    while controller.time_to_first_snapshot is None and not task.done():
+        await asyncio.sleep(0)
+    await idle()
+    started = time.perf_counter()
+    await client.play(idle)
+    elapsed = time.perf_counter() - started
+    await controller.quit()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    return {
+        'address': client.address,
+        'trace_seconds': client.duration,
+        'replay_seconds': elapsed,
+        'notifications': len(client.notifications),
+        'reads': client.reads,
+        'transitions': transitions,
+        'notified': decisions.notified,
+        'suppressed': decisions.suppressed,
+        'writes': [(timestamp, character.name, payload.hex()) for timestamp, character, payload in client.writes],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded GATT trace into a Controller.')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, help='replay at this multiple of real time, as fast as possible if omitted')
+    parser.add_argument('--dump', action='store_true', help='print the recorded events instead of replaying them')
+    args = parser.parse_args()
+
+    if args.dump:
+        address, started, events = read_trace(args.trace)
+        print('# {} recorded at {}'.format(address, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))))
+        for event in events:
+            name = event.character.name if event.character is not None else '-'
+            print('{:12.3f} {:10} {:18} {}'.format(event.timestamp, KINDS.get(event.kind, event.kind), name,
+                                                  event.payload.hex()))
+        return
+    print(json.dumps(asyncio.run(replay(args.trace, args.speed)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
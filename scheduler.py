@@ -0,0 +1,152 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple, Union
+from warnings import warn
+
+from bleak import BleakClient
+from bleak.exc import BleakError
+
+from metrics import Histogram, Metrics
+from utils import Character
+
+
+class RequestScheduler:
+    def __init__(self, client: BleakClient, depth: int = 4, gatt_limit: Union[asyncio.Semaphore, None] = None,
+                 metrics: Union[Metrics, None] = None):
+        self.client = client
+        # how many requests may be outstanding on this connection at once
+        self.depth = depth
+        self.slots = asyncio.Semaphore(depth)
+        # optional limit shared with other connections (see Fleet)
+        self.gatt_limit = gatt_limit
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.operations = 0
+
+        self.metrics = metrics
+        self.histograms: Dict[Tuple[Character, str], Histogram] = {}
+
+    def _histogram(self, character: Character, kind: str) -> Histogram:
+        histogram = self.histograms.get((character, kind))
+        if histogram is None:
+            histogram = self.histograms[character, kind] = self.metrics.histogram(
+                'ember_gatt_seconds', device=self.client.address, characteristic=character.name, operation=kind)
+        return histogram
+
+    async def _run(self, character: Character, kind: str, operation, *args):
+        async with self.slots:
+            if self.gatt_limit is not None:
+                await self.gatt_limit.acquire()
+            self.in_flight += 1
+            self.operations += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            started = time.perf_counter()
+            try:
+                return await operation(*args)
+            except (RuntimeError, BleakError, asyncio.TimeoutError):
+                if self.metrics is not None:
+                    self.metrics.inc('ember_gatt_errors_total', device=self.client.address,
+                                     characteristic=character.name, operation=kind)
+                raise
+            finally:
+                if self.metrics is not None:
+                    self._histogram(character, kind).observe(time.perf_counter() - started)
+                self.in_flight -= 1
+                if self.gatt_limit is not None:
+                    self.gatt_limit.release()
+
+    async def read(self, character: Character) -> bytearray:
+        return await self._run(character, 'read', self.client.read_gatt_char, character.as_uuid)
+
+    async def write(self, character: Character, data: bytearray):
+        return await self._run(character, 'write', self.client.write_gatt_char, character.as_uuid, data)
+
+    async def read_many(self, characters: Iterable[Character],
+                        read: Union[Callable[[Character], Awaitable[bytearray]], None] = None
+                        ) -> Dict[Character, bytearray]:
+        # independent reads are issued together, at most `depth` of them on the radio at a time
+        read = read or self.read
+        characters = list(characters)
+        results = await asyncio.gather(*(read(character) for character in characters), return_exceptions=True)
+        snapshot = {}
+        for character, result in zip(characters, results):
+            if isinstance(result, (RuntimeError, BleakError)):
+                warn(f"reading {character!r} was failed because of Bluetooth error.")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                snapshot[character] = result
+        return snapshot
+
+
+class WriteQueue:
+    def __init__(self, write: Callable[[Character, bytearray], Awaitable], min_interval: float = 0.25):
+        self.write = write
+        # minimum seconds between two writes on this connection
+        self.min_interval = min_interval
+
+        # characteristics keep the position of their first pending write, but only the latest value is sent
+        self.pending: 'OrderedDict[Character, bytearray]' = OrderedDict()
+        self.waiters: Dict[Character, List[asyncio.Future]] = {}
+        self.writing: Union[Character, None] = None
+        self.last_written: Dict[Character, bytearray] = {}
+        self.last_failed: Dict[Character, bytearray] = {}  # failed since the last successful write
+        self.last_write_at = 0.0
+        self.worker: Union[asyncio.Task, None] = None
+
+        self.submitted = 0
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def submit(self, character: Character, data: bytearray) -> asyncio.Future:
+        self.submitted += 1
+        if character in self.pending:
+            self.coalesced += 1
+        self.pending[character] = data
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(character, []).append(future)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self._drain())
+        return future
+
+    def is_pending(self, character: Character) -> bool:
+        return character in self.pending or self.writing is character
+
+    async def _drain(self):
+        while self.pending:
+            wait = self.last_write_at + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            character, data = self.pending.popitem(last=False)
+            waiters = self.waiters.pop(character, [])
+            self.writing = character
+            ok = False
+            try:
+                await self.write(character, data)
+            except (RuntimeError, BleakError, asyncio.TimeoutError):
+                warn(f"writing {character!r} was failed because of Bluetooth error.")
+                self.failed += 1
+                self.last_failed[character] = data
+            else:
+                self.last_written[character] = data
+                self.last_failed.pop(character, None)
+                self.written += 1
+                ok = True
+            finally:
+                self.writing = None
+                self.last_write_at = time.monotonic()
+                # popped waiters are resolved even if the worker is cancelled
+                for future in waiters:
+                    if not future.done():
+                        future.set_result(ok)
+
+    async def flush(self):
+        if self.worker is not None:
+            await asyncio.shield(self.worker)
+
+    def stats(self) -> dict:
+        return {'submitted': self.submitted, 'written': self.written,
+                'coalesced': self.coalesced, 'failed': self.failed, 'pending': len(self.pending)}
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import resource
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Dict, Iterable, List, NamedTuple, Union
+from warnings import warn
+
+from daemon import RequestError, queue_command
+
+
+class ShardSpec(NamedTuple):
+    index: int
+    addresses: List[str]
+    adapter: Union[str, None] = None  # e.g. hci1, mugs of this shard are only connected through it
+    simulate: bool = False
+    max_in_flight: int = 8
+    history_dir: Union[str, None] = None
+
+
+def partition(addresses: Iterable[str], shards: int, adapters: Union[List[str], None] = None,
+              simulate=False, max_in_flight: int = 8, history_dir: Union[str, None] = None) -> List[ShardSpec]:
+    # round robin, so mugs that were found together don't all land on one shard. with adapters, shard i uses
+    # adapters[i % len(adapters)]
+    groups = [[] for _ in range(shards)]
+    for address, group in zip(addresses, itertools.cycle(groups)):
+        group.append(address)
+    return [ShardSpec(i, group, adapters[i % len(adapters)] if adapters else None, simulate, max_in_flight, history_dir)
+            for i, group in enumerate(groups) if group]
+
+
+# worker side. everything below runs in the shard's own process and event loop
+
+def run_shard(spec: ShardSpec, connection: Connection, report_interval: float):
+    try:
+        asyncio.run(serve_shard(spec, connection, report_interval))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve_shard(spec: ShardSpec, connection: Connection, report_interval: float):
+    from fleet import Fleet
+
+    loop = asyncio.get_event_loop()
+    fleet = Fleet(spec.max_in_flight, history_dir=spec.history_dir, adapter=spec.adapter)
+    if spec.simulate:
+        from simulator import SimulatedMug
+        for address in spec.addresses:
+            mug = SimulatedMug(address)
+            await mug.connect()
+            fleet.add(mug)
+    else:
+        await fleet.connect(spec.addresses)
+    running = asyncio.ensure_future(fleet.start())
+
+    async def apply(request_id: int, address: str, command: dict):
+        try:
+            if address not in fleet.controllers:
+                raise RequestError('404 Not Found', 'unknown mug {!r}'.format(address))
+            controller = fleet[address]
+            futures = queue_command(controller, command)
+            written = all(await asyncio.gather(*futures)) if command.get('wait') and futures else None
+            connection.send(('result', request_id, dict(controller.as_dict(), written=written)))
+        except RequestError as e:
+            connection.send(('error', request_id, e.status, str(e)))
+        except ValueError as e:
+            connection.send(('error', request_id, '400 Bad Request', str(e)))
+        except Exception as e:  # the coordinator is waiting for an answer either way
+            warn(f"command for {address!r} failed: {e!r}")
+            connection.send(('error', request_id, '500 Internal Server Error', repr(e)))
+
+    async def report():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = usage.ru_utime + usage.ru_stime
+        operations = notifications = 0
+        while True:
+            expected = time.perf_counter() + report_interval
+            await asyncio.sleep(report_interval)
+            now = time.perf_counter()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            total_operations = sum(controller.scheduler.operations for controller in fleet)
+            total_notifications = sum(controller.bus.published for controller in fleet)
+            elapsed = report_interval + max(0.0, now - expected)
+            load = {
+                'shard': spec.index,
+                'adapter': spec.adapter,
+                'mugs': len(fleet),
+                'running': len(fleet.running()),
+                'cpu_percent': (usage.ru_utime + usage.ru_stime - cpu) / elapsed * 100,
+                'max_rss_kb': usage.ru_maxrss,
+                'loop_lag': max(0.0, now - expected),
+                'gatt_ops_per_sec': (total_operations - operations) / elapsed,
+                'notifications_per_sec': (total_notifications - notifications) / elapsed,
+            }
+            cpu = usage.ru_utime + usage.ru_stime
+            operations, notifications = total_operations, total_notifications
+            connection.send(('report', spec.index, fleet.states(), load))
+
+    reporter = asyncio.ensure_future(report())
+    try:
+        while True:
+            # blocking recv runs on a thread, the loop only sees complete messages
+            message = await loop.run_in_executor(None, connection.recv)
+            if message[0] == 'quit':
+                break
+            if message[0] == 'command':
+                asyncio.ensure_future(apply(*message[1:]))
+    except EOFError:  # the coordinator went away
+        pass
+    finally:
+        reporter.cancel()
+        await fleet.quit()
+        running.cancel()
+        connection.close()
+
+
+# coordinator side
+
+class ShardedFleet:
+    report_interval = 1.0  # seconds between two state and load reports of each shard
+
+    def __init__(self, specs: List[ShardSpec]):
+        self.specs = specs
+        self.owner: Dict[str, int] = {address: spec.index for spec in specs for address in spec.addresses}
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.connections: Dict[int, Connection] = {}
+        self.readers: List[threading.Thread] = []
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.request_ids = itertools.count()
+
+        # latest report of every shard
+        self.shard_states: Dict[int, Dict[str, dict]] = {}
+        self.loads: Dict[int, dict] = {}
+
+    def __len__(self):
+        return len(self.owner)
+
+    async def start(self):
+        # spawn, not fork: a forked child would inherit this process' event loop and bluetooth connections
+        context = multiprocessing.get_context('spawn')
+        loop = asyncio.get_event_loop()
+        for spec in self.specs:
+            ours, theirs = context.Pipe()
+            process = context.Process(target=run_shard, args=(spec, theirs, self.report_interval),
+                                      name='shard-{}'.format(spec.index), daemon=True)
+            process.start()
+            theirs.close()
+            self.processes[spec.index] = process
+            self.connections[spec.index] = ours
+            reader = threading.Thread(target=self._read, args=(spec.index, ours, loop),
+                                      name='shard-{}-reader'.format(spec.index), daemon=True)
+            reader.start()
+            self.readers.append(reader)
+
+    def _read(self, index: int, connection: Connection, loop: asyncio.AbstractEventLoop):
+        # one thread per shard, messages are handed to the event loop
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                return
+            loop.call_soon_threadsafe(self._handle, index, message)
+
+    def _handle(self, index: int, message: tuple):
+        if message[0] == 'report':
+            _, _, states, load = message
+            self.shard_states[index] = states
+            self.loads[index] = load
+        elif message[0] in ('result', 'error'):
+            future = self.pending.pop(message[1], None)
+            if future is None or future.done():
+                return
+            if message[0] == 'result':
+                future.set_result(message[2])
+            else:
+                future.set_exception(RequestError(message[2], message[3]))
+
+    async def wait_ready(self, timeout: float = 30.0):
+        # until every shard has reported once
+        deadline = time.monotonic() + timeout
+        while len(self.loads) < len(self.specs):
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError('shards {} did not report'.format(
+                    sorted(set(self.connections) - set(self.loads))))
+            await asyncio.sleep(0.05)
+
+    async def apply(self, address: str, command: dict, timeout: float = 10.0) -> dict:
+        if address not in self.owner:
+            raise RequestError('404 Not Found', 'unknown mug {!r}'.format(address))
+        request_id = next(self.request_ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        self.connections[self.owner[address]].send(('command', request_id, address, command))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    def states(self) -> Dict[str, dict]:
+        states = {}
+        for shard in self.shard_states.values():
+            states.update(shard)
+        return states
+
+    def load(self) -> Dict[int, dict]:
+        return dict(self.loads)
+
+    async def quit(self, timeout: float = 10.0):
+        for connection in self.connections.values():
+            try:
+                connection.send(('quit',))
+            except (BrokenPipeError, OSError):
+                pass
+        loop = asyncio.get_event_loop()
+        for process in self.processes.values():
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                warn('shard {} did not stop, terminating it'.format(process.name))
+                process.terminate()
+        for connection in self.connections.values():
+            connection.close()
+        for reader in self.readers:
+            reader.join(timeout)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Run mugs across several worker processes.')
+    parser.add_argument('--address', action='append', default=[], help='mug to connect to, may be given more than once')
+    parser.add_argument('--shards', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--adapter', action='append', default=None,
+                        help='bluetooth adapter to pin shards to, shards are spread over all given adapters')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='GATT operations in flight per shard')
+    parser.add_argument('--history-dir', help='persist telemetry history of each mug in this directory')
+    parser.add_argument('--simulate', type=int, default=0, help='run this many simulated mugs instead of real ones')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    args = parser.parse_args()
+
+    addresses = ['SIM:{:05d}'.format(i) for i in range(args.simulate)] if args.simulate else args.address
+    if not addresses:
+        from discovery import KnownDevices
+        addresses = list(KnownDevices())
+    fleet = ShardedFleet(partition(addresses, args.shards, args.adapter, bool(args.simulate), args.max_in_flight,
+                                   args.history_dir))
+    await fleet.start()
+    started = time.monotonic()
+    try:
+        await fleet.wait_ready()
+        while args.duration is None or time.monotonic() - started < args.duration:
+            await asyncio.sleep(fleet.report_interval)
+            print(json.dumps(fleet.load()))
+    finally:
+        await fleet.quit()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,225 @@
+import asyncio
+import inspect
+import random
+from typing import Callable, Dict, Union
+
+from bleak.exc import BleakError
+
+from utils import *
+from codec import lookup
+
+
+class SimulatedMug:
+    tick = 1.0  # simulated seconds per thermal model step
+    heating_rate = 0.35  # °C per second while heating
+    cooling_constant = 0.004  # newton's law of cooling, per second
+    ambient = 22.0
+    discharge_per_second = 0.01  # battery % per second while heating off the coaster
+    charge_per_second = 0.05  # battery % per second on the coaster
+
+    def __init__(self, address: str = 'SIM:00:00:00:00:00', latency: float = 0.02, jitter: float = 0.0,
+                 error_rate: float = 0.0, speed: float = 1.0, seed: Union[int, None] = None):
+        self.address = address
+        self.latency = latency
+        self.jitter = jitter
+        # probability for each GATT operation to raise BleakError
+        self.error_rate = error_rate
+        # simulated seconds per real second, so hours of heating can be run in moments
+        self.speed = speed
+        self.random = random.Random(seed)
+
+        self.temperature = self.ambient
+        self.setting_temperature = 55.0
+        self.temperature_scale = TemperatureScale.Celsius
+        self.color = Color(255, 186, 46, 255)
+        self.battery = 80.0
+        self.on_coaster = True
+        self.filled = False
+        self.state = State.Empty
+
+        self.connected = False
+        self.callbacks: Dict[str, Callable] = {}
+        self.disconnected_callback: Union[Callable, None] = None
+        self.model: Union[asyncio.Task, None] = None
+        self.last_notified_temperature = self.temperature
+
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self.notifications = 0
+
+    @property
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def connect(self, **kwargs) -> bool:
+        await self._delay()
+        self.connected = True
+        if self.model is None or self.model.done():
+            self.model = asyncio.ensure_future(self._run_model())
+        return True
+
+    async def disconnect(self) -> bool:
+        self.connected = False
+        self.callbacks.clear()
+        if self.model is not None:
+            self.model.cancel()
+        return True
+
+    def set_disconnected_callback(self, callback: Union[Callable, None], **kwargs):
+        self.disconnected_callback = callback
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.disconnect()
+
+    async def _delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _operation(self, uuid: str) -> Character:
+        if not self.connected:
+            raise BleakError('Not connected')
+        try:
+            character = lookup(uuid)
+        except KeyError:
+            raise BleakError('Characteristic {} was not found!'.format(uuid))
+        await self._delay()
+        if not self.connected:
+            raise BleakError('Not connected')
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            raise BleakError('simulated failure on {}'.format(character.name))
+        return character
+
+    async def read_gatt_char(self, uuid, **kwargs) -> bytearray:
+        character = await self._operation(uuid)
+        if not character.readable:
+            raise BleakError('{} is not readable'.format(character.name))
+        self.reads += 1
+        return self.value(character)
+
+    async def write_gatt_char(self, uuid, data: bytearray, response: bool = False):
+        character = await self._operation(uuid)
+        if not character.writable:
+            raise BleakError('{} is not writable'.format(character.name))
+        self.writes += 1
+        if character is Request.SettingTemperature:
+            self.setting_temperature = decode_temperature(data)
+        elif character is Request.TemperatureScale:
+            self.temperature_scale = TemperatureScale(data[0])
+        elif character is Request.LightColor:
+            self.color = parse_color(data)
+
+    async def start_notify(self, uuid, callback: Callable, **kwargs):
+        character = await self._operation(uuid)
+        if not character.notify:
+            raise BleakError('{} does not notify'.format(character.name))
+        self.callbacks[character.as_uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self.callbacks.pop(lookup(uuid).as_uuid, None)
+
+    def value(self, character: Character) -> bytearray:
+        if character is Request.Temperature:
+            return encode_temperature(self.temperature)
+        if character is Request.SettingTemperature:
+            return encode_temperature(self.setting_temperature)
+        if character is Request.TemperatureScale:
+            return self.temperature_scale.as_bytearray
+        if character is Request.Battery:
+            return bytearray([int(self.battery), int(self.on_coaster)])
+        if character is Request.State:
+            return bytearray([self.state.value])
+        if character is Request.LightColor:
+            return self.color.as_bytearray
+        raise BleakError('{} is not readable'.format(character.name))
+
+    def emit(self, notification: NotificationValue):
+        callback = self.callbacks.get(Request.Notification.as_uuid)
+        if callback is None:
+            return
+        self.notifications += 1
+        data = bytearray([notification.value])
+        if inspect.iscoroutinefunction(callback):
+            asyncio.ensure_future(callback(Request.Notification.characteristics, data))
+        else:
+            callback(Request.Notification.characteristics, data)
+
+    # events a person would cause
+
+    def pour(self, temperature: float = 80.0):
+        self.filled = True
+        self.temperature = temperature
+        self.state = State.Poured
+        self.emit(NotificationValue.Poured)
+
+    def drink_up(self):
+        self.filled = False
+        self._set_state(State.Empty)
+
+    def lift(self):
+        self.on_coaster = False
+        self.emit(NotificationValue.OffCoaster)
+
+    def put_down(self):
+        self.on_coaster = True
+        self.emit(NotificationValue.OnCoaster)
+
+    def drop(self):
+        # the link is lost without the controller asking for it
+        was_connected = self.connected
+        self.connected = False
+        self.callbacks.clear()
+        if was_connected and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    # thermal model
+
+    def _set_state(self, state: State):
+        if state != self.state:
+            self.state = state
+            self.emit(NotificationValue.HeatingStateChange)
+
+    def step(self, seconds: float):
+        heating = False
+        if not self.filled:
+            self._set_state(State.Empty)
+        elif self.setting_temperature == 0 or (self.battery <= 0 and not self.on_coaster):
+            self._set_state(State.Off)
+        elif self.temperature < self.setting_temperature - 0.5:
+            heating = True
+            self._set_state(State.Heating)
+        elif self.temperature > self.setting_temperature + 0.5:
+            self._set_state(State.Cooling)
+        else:
+            heating = self.temperature < self.setting_temperature
+            self._set_state(State.Keeping)
+
+        if self.filled:
+            self.temperature -= self.cooling_constant * (self.temperature - self.ambient) * seconds
+            if heating:
+                self.temperature += self.heating_rate * seconds
+            self.temperature = round(self.temperature, 2)
+            if abs(self.temperature - self.last_notified_temperature) >= 0.5:
+                self.last_notified_temperature = self.temperature
+                self.emit(NotificationValue.TemperatureChange)
+
+        charge = int(self.battery)
+        if self.on_coaster:
+            self.battery = min(100.0, self.battery + self.charge_per_second * seconds)
+        elif heating:
+            self.battery = max(0.0, self.battery - self.discharge_per_second * seconds)
+        if int(self.battery) != charge:
+            self.emit(NotificationValue.BatteryChargeChange)
+
+    async def _run_model(self):
+        while self.connected:
+            await asyncio.sleep(self.tick / self.speed)
+            self.step(self.tick)
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Union
+from warnings import warn
+
+from utils import BatteryState, Color, State, TemperatureScale
+
+SNAPSHOTS_PATH = os.path.join(os.path.expanduser('~'), '.ember-mug-controller', 'snapshots.json')
+
+# controller attributes kept across restarts. temperature changes too fast to be worth restoring
+PERSISTED = ('color', 'temperature_scale', 'setting_temperature', 'battery', 'state')
+
+
+def encode(name: str, value):
+    if value is None:
+        return None
+    if name == 'color':
+        return value.as_rgba
+    if name == 'temperature_scale' or name == 'state':
+        return value.name
+    if name == 'battery':
+        return [value.battery_charge, value.is_charging]
+    return value
+
+
+def decode(name: str, value):
+    if value is None:
+        return None
+    if name == 'color':
+        return Color(*bytes.fromhex(value.lstrip('#')))
+    if name == 'temperature_scale':
+        return TemperatureScale[value]
+    if name == 'state':
+        return State[value]
+    if name == 'battery':
+        return BatteryState(value[0], bool(value[1]))
+    return float(value)
+
+
+class SnapshotStore:
+    save_delay = 2.0  # seconds to collect changes of every mug before the file is rewritten
+
+    def __init__(self, path: str = SNAPSHOTS_PATH):
+        self.path = path
+        self.snapshots: Dict[str, dict] = {}
+        self.pending: Union[asyncio.TimerHandle, None] = None
+        self.load()
+
+    def __contains__(self, address: str):
+        return address in self.snapshots
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.snapshots = json.load(f)
+        except FileNotFoundError:
+            self.snapshots = {}
+        except (OSError, ValueError) as e:
+            warn(f"could not read snapshots from {self.path!r}: {e!r}")
+            self.snapshots = {}
+
+    def flush(self):
+        # writes changes that are still waiting for save_delay
+        if self.pending is not None:
+            self.save()
+
+    def save(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshots, f, indent=2)
+        os.replace(temporary, self.path)
+
+    def get(self, address: str) -> Dict[str, object]:
+        # decoded values, without the ones that could not be read back
+        values = {}
+        for name, value in self.snapshots.get(address, {}).items():
+            if name not in PERSISTED:
+                continue
+            try:
+                values[name] = decode(name, value)
+            except (KeyError, TypeError, ValueError, IndexError):
+                warn(f"ignoring unreadable {name!r} in the snapshot of {address!r}")
+        return values
+
+    def update(self, address: str, name: str, value):
+        # cheap enough to call on every change, the file is written at most once every save_delay
+        snapshot = self.snapshots.setdefault(address, {})
+        snapshot[name] = encode(name, value)
+        snapshot['saved_at'] = time.time()
+        if self.pending is None:
+            try:
+                self.pending = asyncio.get_running_loop().call_later(self.save_delay, self.save)
+            except RuntimeError:  # not called from a running event loop
+                self.save()
+
@@ -0,0 +1,145 @@
+import asyncio
+import random
+import time
+from typing import Callable, Union
+from warnings import warn
+
+from bleak import BleakClient
+from bleak.exc import BleakError
+
+from controller import Controller
+from utils import Request
+
+
+class ConnectionSupervisor:
+    base_delay = 1.0  # seconds before the first reconnection attempt
+    max_delay = 60.0
+    jitter = 0.3  # +-30% so a fleet that dropped together doesn't reconnect in lockstep
+    check_interval = 5.0  # seconds between is_connected checks, for backends that miss disconnect events
+
+    # values written by us are restored on the mug after reconnecting, including ones queued while it was away
+    restored = (Request.SettingTemperature, Request.LightColor)
+
+    def __init__(self, controller: Controller, client_factory: Union[Callable[[], BleakClient], None] = None,
+                 max_attempts: Union[int, None] = None):
+        self.controller = controller
+        # by default the same client object is connected again
+        self.client_factory = client_factory
+        self.max_attempts = max_attempts
+
+        self.lost = asyncio.Event()
+        self.stopped = False
+        self.task: Union[asyncio.Task, None] = None
+
+        self.disconnects = 0
+        self.reconnects = 0
+        self.attempts = 0
+        self.downtime = 0.0
+        self.down_since: Union[float, None] = None
+
+    def _on_disconnect(self, client):
+        self.lost.set()
+
+    def _watch(self, client):
+        try:
+            client.set_disconnected_callback(self._on_disconnect)
+        except (AttributeError, NotImplementedError):
+            pass
+
+    async def _check(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if not self.controller.client.is_connected:
+                self.lost.set()
+                return
+
+    async def run(self):
+        self._watch(self.controller.client)
+        while not self.stopped and not self.controller.closed:
+            self.lost.clear()
+            self.task = asyncio.ensure_future(self.controller.start())
+            checker = asyncio.ensure_future(self._check())
+            lost = asyncio.ensure_future(self.lost.wait())
+            await asyncio.wait({self.task, lost, checker}, return_when=asyncio.FIRST_COMPLETED)
+            for task in (lost, checker):
+                task.cancel()
+
+            if self.controller.closed or self.stopped:
+                await asyncio.gather(self.task, return_exceptions=True)
+                return
+            if self.task.done() and not self.task.cancelled() and self.task.exception() is None \
+                    and self.controller.client.is_connected:
+                return
+
+            # the connection is gone, or start() crashed on it
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.disconnects += 1
+            self.down_since = time.monotonic()
+            warn(f"connection to {self.controller.address!r} was lost, reconnecting.")
+            if not await self._reconnect():
+                return
+
+    async def _reconnect(self) -> bool:
+        delay = self.base_delay
+        attempts = 0
+        while not self.stopped and not self.controller.closed:
+            if self.max_attempts is not None and attempts >= self.max_attempts:
+                warn(f"giving up on {self.controller.address!r} after {attempts} attempts.")
+                return False
+            attempts += 1
+            self.attempts += 1
+            await asyncio.sleep(delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+            delay = min(delay * 2, self.max_delay)
+
+            client = self.controller.client if self.client_factory is None else self.client_factory()
+            try:
+                if client.is_connected:
+                    await client.disconnect()
+                await client.connect()
+            except (RuntimeError, BleakError, asyncio.TimeoutError, OSError) as e:
+                warn(f"reconnecting to {self.controller.address!r} failed: {e!r}")
+                continue
+
+            if client is not self.controller.client:
+                self.controller.attach(client)
+            else:
+                self.controller.cache.clear()
+            self._watch(client)
+            self.reconnects += 1
+            self.downtime += time.monotonic() - self.down_since
+            self.down_since = None
+            self.restore()
+            return True
+        return False
+
+    def restore(self):
+        # the controller's value is the latest one asked for, last_written may be older than a write that failed
+        controller = self.controller
+        writes = controller.writes
+        for character in self.restored:
+            if character not in writes.last_written and character not in writes.last_failed:
+                continue
+            if character is Request.SettingTemperature and controller.setting_temperature is not None:
+                controller.queue_setting_temperature(controller.setting_temperature)
+            elif character is Request.LightColor and controller.color is not None:
+                controller.queue_color(controller.color)
+
+    async def quit(self):
+        self.stopped = True
+        self.lost.set()
+        await self.controller.quit()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        downtime = self.downtime
+        if self.down_since is not None:
+            downtime += time.monotonic() - self.down_since
+        return {
+            'connected': self.down_since is None and self.controller.client.is_connected,
+            'disconnects': self.disconnects,
+            'reconnects': self.reconnects,
+            'attempts': self.attempts,
+            'downtime': downtime,
+        }
@@ -0,0 +1,151 @@
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+from typing import Iterator, List, Tuple, Union
+
+from utils import State
+
+# timestamp, temperature, setting temperature, battery charge, state code
+RECORD = struct.Struct('<dffbb')
+MAGIC = b'EMBT\x01\x00\x00\x00'
+
+Sample = Tuple[float, float, float, int, int]
+
+
+class TelemetryRecorder:
+    spill_every = 64  # samples buffered before they are appended to the history file
+
+    def __init__(self, capacity: int = 4096, path: Union[str, None] = None, max_file_bytes: int = 64 * 1024 * 1024):
+        self.capacity = capacity
+        # one preallocated array per column, so memory doesn't grow with uptime
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.temperatures = array('f', bytes(4 * capacity))
+        self.setting_temperatures = array('f', bytes(4 * capacity))
+        self.batteries = array('b', bytes(capacity))
+        self.states = array('b', bytes(capacity))
+        self.head = 0
+        self.count = 0
+
+        self.path = path
+        self.max_file_bytes = max_file_bytes
+        self.pending = bytearray()
+        self.spilled = 0
+
+        self.temperature = math.nan
+        self.setting_temperature = math.nan
+        self.battery = -1
+        self.state = -1
+
+    def __len__(self):
+        return self.count
+
+    def attach(self, controller: 'Controller'):
+        controller.subscribe(self.on_change)
+
+    def on_change(self, name: str, value):
+        # controller attributes are merged into one row, unknown values are stored as nan/-1
+        if name == 'temperature':
+            self.temperature = math.nan if value is None else value
+        elif name == 'setting_temperature':
+            self.setting_temperature = math.nan if value is None else value
+        elif name == 'battery':
+            self.battery = -1 if value is None else value.battery_charge
+        elif name == 'state':
+            self.state = -1 if value is None else value.value
+        else:
+            return
+        self.record(time.time(), self.temperature, self.setting_temperature, self.battery, self.state)
+
+    def record(self, timestamp: float, temperature: float, setting_temperature: float, battery: int, state: int):
+        i = self.head
+        self.timestamps[i] = timestamp
+        self.temperatures[i] = temperature
+        self.setting_temperatures[i] = setting_temperature
+        self.batteries[i] = battery
+        self.states[i] = state
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+        if self.path is not None:
+            self.pending += RECORD.pack(timestamp, temperature, setting_temperature, battery, state)
+            if len(self.pending) >= self.spill_every * RECORD.size:
+                self.flush()
+
+    def latest(self, n: Union[int, None] = None) -> List[Sample]:
+        n = self.count if n is None else min(n, self.count)
+        first = (self.head - n) % self.capacity
+        rows = []
+        for k in range(n):
+            i = (first + k) % self.capacity
+            rows.append((self.timestamps[i], self.temperatures[i], self.setting_temperatures[i],
+                         self.batteries[i], self.states[i]))
+        return rows
+
+    def flush(self):
+        if self.path is None or not self.pending:
+            return
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(self.pending) > self.max_file_bytes:
+            # keep a single previous generation so disk use is bounded too
+            os.replace(self.path, self.path + '.1')
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(MAGIC)
+            f.write(self.pending)
+        self.spilled += len(self.pending) // RECORD.size
+        self.pending.clear()
+
+
+class History:
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.mmap = None
+        self.view = memoryview(b'')
+        if size >= len(MAGIC):
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.mmap[:len(MAGIC)] != MAGIC:
+                self.close()
+                raise ValueError('{!r} is not a telemetry history file'.format(path))
+            usable = len(MAGIC) + (size - len(MAGIC)) // RECORD.size * RECORD.size
+            # records are read straight out of the page cache
+            self.view = memoryview(self.mmap)[len(MAGIC):usable]
+
+    def __len__(self):
+        return len(self.view) // RECORD.size
+
+    def __getitem__(self, index: int) -> Sample:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return RECORD.unpack_from(self.view, index * RECORD.size)
+
+    def __iter__(self) -> Iterator[Sample]:
+        return RECORD.iter_unpack(self.view)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+
+def describe(sample: Sample) -> dict:
+    timestamp, temperature, setting_temperature, battery, state = sample
+    return {
+        'timestamp': timestamp,
+        'temperature': None if math.isnan(temperature) else round(temperature, 2),
+        'setting_temperature': None if math.isnan(setting_temperature) else round(setting_temperature, 2),
+        'battery': None if battery < 0 else battery,
+        'state': None if state < 0 else State(state).name,
+    }
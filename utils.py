@@ -1,10 +1,19 @@
+import struct
 from enum import IntEnum, Enum
 
 CharacteristicBase = 'FC5400{:02x}-236C-4C94-8FA9-944A3E5353FA'
 EMBER_MANUFACTURER_CODE = 0xFFFF
 
+# wire formats, all little endian
+TEMPERATURE_STRUCT = struct.Struct('<H')  # 1/100 °C
+BATTERY_STRUCT = struct.Struct('<BB')  # charge %, charging flag
+COLOR_STRUCT = struct.Struct('<BBBB')  # r, g, b, a
+BYTE_STRUCT = struct.Struct('<B')  # state, temperature scale, notification
+
 
 class Temperature:
+    __slots__ = ('value', 'scale')
+
     def __init__(self, value: float, scale: str = 'celsius'):
         # Ember uses celsius for internal processing
         self.value = value
@@ -45,13 +54,19 @@ class TemperatureConversion:
 class Character:
     def __init__(self, characteristics: int, readable: bool = False, writable: bool = False, notify: bool = False):
         self.characteristics = characteristics
+        self.uuid = CharacteristicBase.format(characteristics)
         self.readable = readable
         self.writable = writable
         self.notify = notify
+        self.name = '0x{:02x}'.format(characteristics)
+
+    def __set_name__(self, owner, name):
+        # name as declared on Request, e.g. 'Temperature'
+        self.name = name
 
     @property
     def as_uuid(self) -> str:
-        return CharacteristicBase.format(self.characteristics)
+        return self.uuid
 
     def __repr__(self):
         return 'Character(characteristics={!r}, readable={!r}, ' \
@@ -88,10 +103,12 @@ class TemperatureScale(IntEnum):
 
     @property
     def as_bytearray(self) -> bytearray:
-        return bytearray.fromhex('{:02}'.format(self.value))
+        return bytearray(BYTE_STRUCT.pack(self.value))
 
 
 class Color:
+    __slots__ = ('r', 'g', 'b', 'a')
+
     def __init__(self, r: int, g: int, b: int, a: int = 255):
         self.r = r
         self.g = g
@@ -100,7 +117,7 @@ class Color:
 
     @property
     def as_bytearray(self) -> bytearray:
-        return bytearray([self.r, self.g, self.b, self.a])
+        return bytearray(COLOR_STRUCT.pack(self.r, self.g, self.b, self.a))
 
     @property
     def as_rgb(self) -> str:
@@ -110,6 +127,14 @@ class Color:
     def as_rgba(self) -> str:
         return '#{:02x}{:02x}{:02x}{:02x}'.format(self.r, self.g, self.b, self.a)
 
+    def __eq__(self, other):
+        if not isinstance(other, Color):
+            return NotImplemented
+        return (self.r, self.g, self.b, self.a) == (other.r, other.g, other.b, other.a)
+
+    def __hash__(self):
+        return hash((self.r, self.g, self.b, self.a))
+
     def __repr__(self):
         return 'Color(r={!r}, g={!r}, b={!r}, a={!r})'.format(self.r, self.g, self.b, self.a)
 
@@ -127,30 +152,43 @@ class Request:
 
 
 class BatteryState:
+    __slots__ = ('battery_charge', 'is_charging')
+
     def __init__(self, battery_charge: int, is_charging: bool):
         self.battery_charge = battery_charge
         self.is_charging = is_charging
 
+    def __eq__(self, other):
+        if not isinstance(other, BatteryState):
+            return NotImplemented
+        return (self.battery_charge, self.is_charging) == (other.battery_charge, other.is_charging)
+
+    def __hash__(self):
+        return hash((self.battery_charge, self.is_charging))
+
     def __repr__(self):
         return 'BatteryState(battery_charge={!r}, is_charging={!r})'.format(self.battery_charge, self.is_charging)
 
 
 def decode_temperature(value: bytearray) -> float:
-    return int.from_bytes(value, byteorder='little') / 100
+    if len(value) == TEMPERATURE_STRUCT.size:
+        return TEMPERATURE_STRUCT.unpack(value)[0] / 100
+    return int.from_bytes(value, byteorder='little') / 100  # whatever else the mug sends, as before
 
 
 def encode_temperature(value: float) -> bytearray:
-    return bytearray(round(value*100).to_bytes(length=2, byteorder='little'))
+    return bytearray(TEMPERATURE_STRUCT.pack(round(value*100)))
 
 
 def parse_battery(value: bytearray) -> BatteryState:
-    battery = value[0]
-    is_charging = bool(value[1])
-    return BatteryState(battery, is_charging)
+    # indexing beats struct for payloads this small
+    return BatteryState(value[0], bool(value[1]))
 
 
 def parse_color(value: bytearray) -> Color:
-    return Color(*value)
+    if len(value) == COLOR_STRUCT.size:
+        return Color(value[0], value[1], value[2], value[3])
+    return Color(*value)  # e.g. 3 bytes without alpha
 
 
 if __name__ == '__main__':